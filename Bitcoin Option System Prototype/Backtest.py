@@ -0,0 +1,218 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import traceback
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+# Historical recalibration and backtest runner (headless)
+## Snapshots: a directory of option chains in the btcOptionsData.csv layout, the snapshot time in the file name,
+## e.g. btcOptionsData_2022-05-19_0130.csv or 20220519.csv
+## Each snapshot: SVI surface of the chain -> Heston calibration -> exotic book priced by Monte Carlo
+## Dates are split into contiguous chunks over a process pool, inside a chunk each date is warm-started from the previous one;
+## the first date of each chunk is calibrated beforehand in a quick serial pass, chained from the previous chunk's first date
+## Every finished date is checkpointed to its own JSON file, a rerun skips the dates already done
+##
+## python Backtest.py snapshots/ --output backtest.parquet --workers 4
+
+snapshotPattern = re.compile(r'(\d{4})-?(\d{2})-?(\d{2})(?:[_T ]?(\d{2}):?(\d{2}))?')
+
+# Exotic book priced on every date, strikes and barriers relative to the spot of the date
+## (name, tenor in days, payoff builder of the spot)
+book = [('digitalCall110', 30, lambda spot: ('Digital', 'Call', 1.1*spot, None)),
+        ('digitalPut90', 30, lambda spot: ('Digital', 'Put', 0.9*spot, None)),
+        ('downoutCall100B80', 30, lambda spot: ('Barrier', 'Call', spot, 0.8*spot)),
+        ('downoutPut100B80', 30, lambda spot: ('Barrier', 'Put', spot, 0.8*spot)),
+        ('asianCall100', 30, lambda spot: ('Asian', 'Call', spot, None))]
+
+def snapshotTime(filename):
+    match = snapshotPattern.search(os.path.basename(filename))
+    if match is None:
+        return None
+    year, month, day, hour, minute = match.groups()
+    return datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0))
+
+def listSnapshots(directory):
+    snapshots = []
+    for filename in os.listdir(directory):
+        valuationTime = snapshotTime(filename)
+        if filename.endswith('.csv') and valuationTime is not None:
+            snapshots.append((valuationTime, os.path.join(directory, filename)))
+    return sorted(snapshots)
+
+def checkpointFile(checkpointDir, valuationTime):
+    return os.path.join(checkpointDir, valuationTime.strftime('%Y%m%d_%H%M') + '.json')
+
+def loadCheckpoints(checkpointDir):
+    rows = {}
+    for filename in os.listdir(checkpointDir):
+        if filename.endswith('.json'):
+            with open(os.path.join(checkpointDir, filename)) as f:
+                row = json.load(f)
+            rows[row['time']] = row
+    return rows
+
+# Spot of a snapshot: the underlying column when the chain has one, the nearest forward otherwise
+def snapshotSpot(df, volSurface):
+    for column in ('underlying_price', 'index_price'):
+        if column in df:
+            return float(df[column].iloc[0])
+    return float(volSurface.forwards[0])
+
+def priceBook(calibration, path, seed):
+    import HestonModel
+    import Payoff
+
+    simulation = HestonModel.ExoticOptionSimulation(calibration)
+    prices = {}
+    for name, tenor, terms in book:
+        optionType, callPut, strike, barrier = terms(calibration.spot)
+        if optionType == 'Digital':
+            payoff = Payoff.DigitalPayoff(callPut, strike)
+        elif optionType == 'Barrier':
+            payoff = Payoff.BarrierPayoff(callPut, strike, downBarrier = barrier)
+        else:
+            payoff = Payoff.AsianPayoff(callPut, strike)
+        maturity = str((calibration.calculation_date + tenor).to_date())
+        NPV, = simulation.NPV(maturity, [payoff], path, seed)
+        prices[name] = float(NPV)
+    return prices
+
+# Surface fit and Heston calibration of one snapshot
+def calibrateSnapshot(filename, valuationTime, volSurface, initialParams):
+    import QuantLib as ql
+    import HestonModel
+
+    df = pd.read_csv(filename)
+    volSurface.fitChain(df, valuationTime)
+    spot = snapshotSpot(df, volSurface)
+    return HestonModel.Calibration(ql.Date(valuationTime.day, valuationTime.month, valuationTime.year), spot, volSurface, initialParams)
+
+# One snapshot, returns the row of the time series
+def runSnapshot(filename, valuationTime, volSurface, initialParams, path, seed):
+    start = time.perf_counter()
+    calibration = calibrateSnapshot(filename, valuationTime, volSurface, initialParams)
+    spot = calibration.spot
+    row = {'time': valuationTime.isoformat(), 'spot': spot,
+           'v0': calibration.v0, 'kappa': calibration.kappa, 'theta': calibration.theta, 'sigma': calibration.sigma, 'rho': calibration.rho,
+           'fitError': calibration.fitError, 'surfaceError': volSurface.fitError()*100, 'warmStart': initialParams is not None}
+    row.update(priceBook(calibration, path, seed))
+    row['seconds'] = time.perf_counter() - start
+    return row
+
+# Worker: contiguous dates, each warm-started from the previous calibration of the chunk
+## A failed date is reported and not checkpointed, the next date keeps the last good warm start
+def runChunk(snapshots, checkpointDir, initialParams, path, seed):
+    import VolSurface
+
+    volSurface = VolSurface.VolSurface('SVI')
+    rows = []
+    for valuationTime, filename in snapshots:
+        try:
+            row = runSnapshot(filename, valuationTime, volSurface, initialParams, path, seed)
+        except Exception:
+            rows.append({'time': valuationTime.isoformat(), 'error': traceback.format_exc(limit = 1).strip()})
+            volSurface = VolSurface.VolSurface('SVI')
+            continue
+        initialParams = {name: row[name] for name in ('v0', 'kappa', 'theta', 'sigma', 'rho')}
+
+        # Write then rename, an interrupted run never leaves a partial checkpoint
+        target = checkpointFile(checkpointDir, valuationTime)
+        with open(target + '.tmp', 'w') as f:
+            json.dump(row, f)
+        os.replace(target + '.tmp', target)
+        rows.append(row)
+    return rows
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+# Columnar output: parquet when an engine is installed, CSV otherwise
+def writeTimeSeries(rows, output):
+    df = pd.DataFrame(rows).sort_values('time').reset_index(drop = True)
+    if output.endswith('.parquet'):
+        try:
+            df.to_parquet(output, index = False)
+            return output
+        except ImportError:
+            output = output[:-len('.parquet')] + '.csv'
+            print('No parquet engine installed, writing %s' % (output, ), file = sys.stderr)
+    df.to_csv(output, index = False)
+    return output
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Recalibrate the Heston model on historical snapshots and reprice an exotic book')
+    parser.add_argument('snapshots', help = 'directory of option chain CSV files, snapshot time in the file name')
+    parser.add_argument('--output', default = 'backtest.parquet', help = 'time series of parameters, fit errors and prices (.parquet or .csv)')
+    parser.add_argument('--checkpoint', default = None, help = 'checkpoint directory (default: <output>.checkpoint)')
+    parser.add_argument('--workers', type = int, default = os.cpu_count())
+    parser.add_argument('--chunk', type = int, default = 8, help = 'dates per warm-started chunk')
+    parser.add_argument('--path', type = int, default = 20000, help = 'Monte Carlo paths per price')
+    parser.add_argument('--seed', type = int, default = 42)
+    args = parser.parse_args(argv)
+
+    checkpointDir = args.checkpoint or os.path.splitext(args.output)[0] + '.checkpoint'
+    os.makedirs(checkpointDir, exist_ok = True)
+
+    snapshots = listSnapshots(args.snapshots)
+    done = loadCheckpoints(checkpointDir)
+    todo = [snapshot for snapshot in snapshots if snapshot[0].isoformat() not in done]
+    print('%d snapshots, %d checkpointed, %d to run' % (len(snapshots), len(snapshots) - len(todo), len(todo)))
+
+    # Latest calibration up to a date, checkpointed or from the serial pass below, if any
+    seeds = {}
+    def warmStart(valuationTime):
+        previous = [row for key, row in list(done.items()) + list(seeds.items()) if key <= valuationTime.isoformat()]
+        if not previous:
+            return None
+        row = max(previous, key = lambda row: row['time'])
+        return {name: row[name] for name in ('v0', 'kappa', 'theta', 'sigma', 'rho')}
+
+    # Chunks run in parallel, the first date of a chunk cannot wait for the end of the previous chunk:
+    ## the first date of every chunk is calibrated serially (no pricing), each warm-started from the previous one,
+    ## and a chunk starts from the calibration of its own first date instead of the cookbook guess
+    ## The first chunk starts from the checkpoints only, a failed date leaves its chunk the last good calibration
+    start = time.perf_counter()
+    batches = chunks(todo, args.chunk)
+    initialParams = [warmStart(batches[0][0][0])] if batches else []
+    if len(batches) > 1:
+        import VolSurface
+        volSurface = VolSurface.VolSurface('SVI')
+        for chunk in batches:
+            valuationTime, filename = chunk[0]
+            try:
+                calibration = calibrateSnapshot(filename, valuationTime, volSurface, warmStart(valuationTime))
+            except Exception:
+                volSurface = VolSurface.VolSurface('SVI')
+                continue
+            seeds[valuationTime.isoformat()] = {'time': valuationTime.isoformat(), 'v0': calibration.v0, 'kappa': calibration.kappa,
+                                                'theta': calibration.theta, 'sigma': calibration.sigma, 'rho': calibration.rho}
+        initialParams += [warmStart(chunk[0][0]) for chunk in batches[1:]]
+        print('%d chunk starts calibrated in %.1fs' % (len(seeds), time.perf_counter() - start))
+
+    rows = list(done.values())
+    failed = 0
+    with ProcessPoolExecutor(max_workers = args.workers) as executor:
+        futures = [executor.submit(runChunk, chunk, checkpointDir, params, args.path, args.seed)
+                   for chunk, params in zip(batches, initialParams)]
+        for future in as_completed(futures):
+            for row in future.result():
+                if 'error' in row:
+                    failed += 1
+                    print('%s failed: %s' % (row['time'], row['error']), file = sys.stderr)
+                else:
+                    rows.append(row)
+                    print('%s  fitError %.4f  %.1fs' % (row['time'], row['fitError'], row['seconds']))
+
+    if rows:
+        output = writeTimeSeries(rows, args.output)
+        print('%d dates in %s (%d failed, %.1fs)' % (len(rows), output, failed, time.perf_counter() - start))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,210 +1,477 @@
+import time
+import threading
+from contextlib import contextmanager
+from collections import namedtuple
+from statistics import NormalDist
+
 import QuantLib as ql
 import numpy as np
 
-class Calibration():
-    def __init__(self):
+import Payoff
+import ImpliedVolatility
+
+# QuantLib keeps the evaluation date in a process-wide singleton (ql.Settings)
+## QuantLib calls of a context run inside its evaluation() block: the lock is held and the global date
+## is switched to the context's valuation date, then restored, so contexts of different dates and
+## threads do not corrupt each other; the NumPy Monte Carlo engine never touches it and runs outside the lock
+quantLibLock = threading.RLock()
+
+# Valuation date, spot and curves of one pricing snapshot
+## Defaults reproduce the prototype snapshot (22 Nov 2021)
+class PricingContext():
+    def __init__(self, calculation_date = None, spot = None):
         self.day_count = ql.Actual365Fixed()
         self.calendar  = ql.NullCalendar()
 
-        self.calculation_date = ql.Date(22, 11, 2021)
+        self.calculation_date = ql.Date(22, 11, 2021) if calculation_date is None else calculation_date
         calDate = str(self.calculation_date.to_date())
-        self.spot = 57407.27
-
-        ql.Settings.instance().evaluationDate = self.calculation_date
+        self.spot = 57407.27 if spot is None else spot
+        self.snapshotId = calDate + '@' + str(self.spot)
 
         self.risk_free_rate = [0.00091249886, 0.00091249886, 0.00141713916, 0.00178991217, 0.00308713517] # 2021/11/02 0D 1D 3M 6M 12M
-        risk_free_rate_date = [ql.Date(22, 11, 2021), ql.Date(23, 11, 2021), ql.Date(23, 2, 2022), ql.Date(23, 5, 2022), ql.Date(23, 11, 2022)]
-        self.zero_curve_ts = ql.YieldTermStructureHandle(ql.ZeroCurve(risk_free_rate_date, self.risk_free_rate, self.day_count, self.calendar))
+        if self.calculation_date == ql.Date(22, 11, 2021):
+            risk_free_rate_date = [ql.Date(22, 11, 2021), ql.Date(23, 11, 2021), ql.Date(23, 2, 2022), ql.Date(23, 5, 2022), ql.Date(23, 11, 2022)]
+        else:
+            # Same term structure rolled to the snapshot date
+            risk_free_rate_date = [self.calculation_date + period for period in (ql.Period(0, ql.Days), ql.Period(1, ql.Days), ql.Period(3, ql.Months), ql.Period(6, ql.Months), ql.Period(12, ql.Months))]
 
         self.dividend_rate = 0.0
-        self.dividend_ts = ql.YieldTermStructureHandle(ql.FlatForward(self.calculation_date, self.dividend_rate, self.day_count))
-        
-        # Dummy parameters for construct Heston model
-        v0 = 0.01; kappa = 0.20; theta = 0.02; rho = -0.75; sigma = 0.50 # cookbook
-        # v0 = 0.1; kappa = 0.1; theta = 0.1; rho = -0.1; sigma = 0.1
-        HestonProcess = ql.HestonProcess(self.zero_curve_ts, self.dividend_ts, ql.QuoteHandle(ql.SimpleQuote(self.spot)), v0, kappa, theta, sigma, rho)
-        HestonModel = ql.HestonModel(HestonProcess)
-        AHE = ql.AnalyticHestonEngine(HestonModel)
-        
-        # 合約到期日
-        expiration_dates = [ql.Date(31, 12, 2021), ql.Date(25, 3, 2022), ql.Date(24, 6, 2022)]
-        # 合約標的
-        strikes = [30000, 40000, 50000, 60000, 70000, 80000, 90000, 100000, 120000]
-        # 合約標的的隱含波動率
-        data = [[1.1340, 0.9864, 0.8955, 0.8344, 0.8328, 0.8692, 0.9165, 0.9808, 1.0735],
-                [1.0149, 0.9587, 0.9241, 0.9046, 0.9000, 0.9055, 0.9177, 0.9338, 0.9684],
-                [0.9697, 0.9399, 0.9193, 0.9098, 0.9073, 0.9089, 0.9128, 0.9181, 0.9497]]
-
-        # Implied Volatility Matrix
-        implied_vols = ql.Matrix(len(strikes), len(expiration_dates))
-        for i in range(implied_vols.rows()):
-            for j in range(implied_vols.columns()):
-                implied_vols[i][j] = data[j][i]
-                
-        black_var_surface = ql.BlackVarianceSurface(self.calculation_date, self.calendar, expiration_dates, strikes, implied_vols, self.day_count)
+        with self.evaluation():
+            self.zero_curve_ts = ql.YieldTermStructureHandle(ql.ZeroCurve(risk_free_rate_date, self.risk_free_rate, self.day_count, self.calendar))
+            self.dividend_ts = ql.YieldTermStructureHandle(ql.FlatForward(self.calculation_date, self.dividend_rate, self.day_count))
+
+    # 'YYYY-MM-DD' maturity: its ql.Date, days from the valuation date (the Monte Carlo steps)
+    # and discount factor exp(-r*T) of the zero curve
+    def maturitySchedule(self, maturity):
+        year = int(maturity[0:4])
+        month = int(maturity[5:7])
+        day = int(maturity[8:10])
+        maturity = ql.Date(day, month, year)
+        step = maturity - self.calculation_date
+        if step < 0:
+            raise ValueError('Maturity %s is before the valuation date %s' % (maturity.to_date(), self.calculation_date.to_date()))
+        T = step/365
+        with self.evaluation():
+            r = self.zero_curve_ts.zeroRate(maturity, self.day_count, ql.Continuous).rate()
+        return maturity, step, np.exp(-r*T)
+
+    @contextmanager
+    def evaluation(self):
+        with quantLibLock:
+            settings = ql.Settings.instance()
+            previous = settings.evaluationDate
+            settings.evaluationDate = self.calculation_date
+            try:
+                yield self
+            finally:
+                settings.evaluationDate = previous
+
+# Heston calibration to one market snapshot, the calibrated QuantLib model is kept as self.model
+## calculation_date, spot  : snapshot date (ql.Date) and spot
+## volSurface              : VolSurface.VolSurface of the snapshot, helpers are quoted from it instead of the vol matrix
+## initialParams           : {'v0', 'kappa', 'theta', 'sigma', 'rho'} starting point, e.g. the previous date's calibration
+## params                  : {'v0', 'kappa', 'theta', 'sigma', 'rho'} already calibrated (e.g. in another process), the model is built without fitting
+## calibration             : a Calibration to share, its context and model are reused as is
+## The pricers below are Calibrations: pass calibration (or params) to price any snapshot without recalibrating
+class Calibration(PricingContext):
+    def __init__(self, calculation_date = None, spot = None, volSurface = None, initialParams = None, params = None, calibration = None):
+        if calibration is not None:
+            self.__dict__.update(calibration.__dict__)
+            return
+        super().__init__(calculation_date, spot)
+        calDate = str(self.calculation_date.to_date())
+
+        with self.evaluation():
+            # Dummy parameters for construct Heston model
+            v0 = 0.01; kappa = 0.20; theta = 0.02; rho = -0.75; sigma = 0.50 # cookbook
+            # v0 = 0.1; kappa = 0.1; theta = 0.1; rho = -0.1; sigma = 0.1
+            if params is not None:
+                initialParams = params
+            if initialParams is not None:
+                v0 = initialParams['v0']; kappa = initialParams['kappa']; theta = initialParams['theta']; rho = initialParams['rho']; sigma = initialParams['sigma']
+            HestonProcess = ql.HestonProcess(self.zero_curve_ts, self.dividend_ts, ql.QuoteHandle(ql.SimpleQuote(self.spot)), v0, kappa, theta, sigma, rho)
+            HestonModel = ql.HestonModel(HestonProcess)
+            if params is None:
+                AHE = ql.AnalyticHestonEngine(HestonModel)
         
-        heston_helpers = []
-        black_var_surface.setInterpolation("bicubic")
-        maturity_idx = 1
-        date = expiration_dates[maturity_idx]
-
-        for j, s in enumerate(strikes):
-            t = (date - self.calculation_date)
-            period = ql.Period(t, ql.Days)
-            vol = data[maturity_idx][j]
-            helper = ql.HestonModelHelper(period, self.calendar, self.spot, s, 
-                                        ql.QuoteHandle(ql.SimpleQuote(vol)),
-                                        self.zero_curve_ts, 
-                                        self.dividend_ts)
-            helper.setPricingEngine(AHE)
-            heston_helpers.append(helper)
+                heston_helpers = []
+                if volSurface is None:
+                    # 合約到期日
+                    expiration_dates = [ql.Date(31, 12, 2021), ql.Date(25, 3, 2022), ql.Date(24, 6, 2022)]
+                    # 合約標的
+                    strikes = [30000, 40000, 50000, 60000, 70000, 80000, 90000, 100000, 120000]
+                    # 合約標的的隱含波動率
+                    data = [[1.1340, 0.9864, 0.8955, 0.8344, 0.8328, 0.8692, 0.9165, 0.9808, 1.0735],
+                            [1.0149, 0.9587, 0.9241, 0.9046, 0.9000, 0.9055, 0.9177, 0.9338, 0.9684],
+                            [0.9697, 0.9399, 0.9193, 0.9098, 0.9073, 0.9089, 0.9128, 0.9181, 0.9497]]
+
+                    # Implied Volatility Matrix
+                    implied_vols = ql.Matrix(len(strikes), len(expiration_dates))
+                    for i in range(implied_vols.rows()):
+                        for j in range(implied_vols.columns()):
+                            implied_vols[i][j] = data[j][i]
+                    
+                    black_var_surface = ql.BlackVarianceSurface(self.calculation_date, self.calendar, expiration_dates, strikes, implied_vols, self.day_count)
+            
+                    black_var_surface.setInterpolation("bicubic")
+                    maturity_idx = 1
+                    date = expiration_dates[maturity_idx]
+                    quotes = [(date - self.calculation_date, s, data[maturity_idx][j]) for j, s in enumerate(strikes)]
+                else:
+                    # Listed expiries between a week and a year, strikes around each forward
+                    quotes = []
+                    for T in volSurface.expiries:
+                        t = int(round(T*365))
+                        if t < 7 or t > 366:
+                            continue
+                        forward = volSurface.forward(T)
+                        for moneyness in (0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.25, 1.5, 1.8):
+                            quotes.append((t, forward*moneyness, float(volSurface.vol(T, forward*moneyness))))
+                    if not quotes:
+                        raise ValueError('No expiry between a week and a year on the vol surface')
+
+                for t, s, vol in quotes:
+                    period = ql.Period(t, ql.Days)
+                    helper = ql.HestonModelHelper(period, self.calendar, self.spot, s, 
+                                                ql.QuoteHandle(ql.SimpleQuote(vol)),
+                                                self.zero_curve_ts, 
+                                                self.dividend_ts)
+                    helper.setPricingEngine(AHE)
+                    heston_helpers.append(helper)
             
-        HestonModel.calibrate(heston_helpers, ql.LevenbergMarquardt(), ql.EndCriteria(500, 50, 1.0e-8, 1.0e-8, 1.0e-8))
+                HestonModel.calibrate(heston_helpers, ql.LevenbergMarquardt(), ql.EndCriteria(500, 50, 1.0e-8, 1.0e-8, 1.0e-8))
 
-        self.theta, self.kappa, self.sigma, self.rho, self.v0 = HestonModel.params()
-        self.params = {'CalDate': calDate, 'Spot': self.spot, 'v0': self.v0, 'rho': self.rho, 'kappa': self.kappa, 'theta': self.theta, 'sigma': self.sigma}
+            self.model = HestonModel
+            self.theta, self.kappa, self.sigma, self.rho, self.v0 = HestonModel.params()
+            self.params = {'CalDate': calDate, 'Spot': self.spot, 'v0': self.v0, 'rho': self.rho, 'kappa': self.kappa, 'theta': self.theta, 'sigma': self.sigma}
+
+            # Fit error: relative price error of each helper and their root mean square
+            ## calibrationQuotes: (days to maturity, strike, implied volatility) of each helper
+            if params is None:
+                self.calibrationQuotes = [(int(t), float(s), float(vol)) for t, s, vol in quotes]
+                self.calibrationErrors = [helper.calibrationError() for helper in heston_helpers]
+                self.fitError = float(np.sqrt(np.mean(np.square(self.calibrationErrors))))
+            else:
+                self.calibrationQuotes = []
+                self.calibrationErrors = []
+                self.fitError = None
         
+# Adaptive Monte Carlo result: estimate, confidence interval, standard error and number of paths used
+MCResult = namedtuple('MCResult', ['NPV', 'lower', 'upper', 'standardError', 'path'])
+
+# Conditional Monte Carlo digital result: discounted NPV, its standard error and pathwise Greeks
+DigitalResult = namedtuple('DigitalResult', ['NPV', 'standardError', 'delta', 'gamma', 'path'])
+
 class MonteCarloSimulation():
+    # Discretization scheme of hestonSteps, part of the pricing cache key
+    scheme = 'LogEuler'
+
     def __init__(self):
         pass
     
-    def hestonModel(self, S0, mu, v0, kappa, theta, sigma, rho, step, path):
+    # Euler scheme on log S (the spot stays positive) and on v (full truncation), yields (St, vt) of t = 0, ..., step - 1 one date at a time
+    def hestonSteps(self, S0, mu, v0, kappa, theta, sigma, rho, step, path, seed = None):
         dt = 1/365
+        rng = np.random.RandomState(seed)
+
+        vt = np.full(path, float(v0))
+        St = np.full(path, float(S0))
+        yield St, vt
 
-        MU  = np.array([0, 0])
-        COV = np.matrix([[1, rho], [rho, 1]])
-        W = np.zeros((step, 2, path))
-        for i in range(path):
-            W[:,:,i]   = np.random.multivariate_normal(MU, COV, step)
-        W_S = np.transpose(W[:, 0, :])
-        W_v = np.transpose(W[:, 1, :])
+        for t in range(1, step):
+            W_S = rng.standard_normal(path)
+            W_v = rho*W_S + np.sqrt(1 - rho**2)*rng.standard_normal(path)
+            sqrt_vdt = np.sqrt(np.abs(vt)*dt)
+            vt, St = np.maximum(vt + kappa*(theta - vt)*dt + sigma*sqrt_vdt*W_v, 0), St*np.exp((mu - vt/2)*dt + sqrt_vdt*W_S)
+            yield St, vt
 
-        vt = np.zeros((path, step))
-        St = np.zeros((path, step))
-        vt[:, 0] = v0
-        St[:, 0] = S0
+    # Only the running statistics of the payoffs are kept instead of the full paths
+    ## pathStore: optional PathStore.PathStore, the paths are simulated once and read back in blocks of dates
+    ## A maturity on the valuation date (step 0) is observed at t = 0 as step 1
+    def hestonPayoffs(self, S0, mu, v0, kappa, theta, sigma, rho, step, path, payoffs, seed = None, pathStore = None):
+        step = max(step, 1)
+        stats = Payoff.RunningStatistics(Payoff.requiredStatistics(payoffs), path)
+        if pathStore is None:
+            for St, vt in self.hestonSteps(S0, mu, v0, kappa, theta, sigma, rho, step, path, seed):
+                stats.update(St)
+        else:
+            S = pathStore.paths(self, (S0, mu, v0, kappa, theta, sigma, rho), step, path, seed)
+            for t in range(0, step, 64):
+                stats.update(S[:, t:t + 64])
+        return [payoff.value(stats) for payoff in payoffs]
 
+    # Variance process only, for conditional Monte Carlo
+    ## Per path: integrated variance V = sum v*dt and variance noise I = sum sqrt(v*dt)*W_v,
+    ## over the same step - 1 increments as hestonSteps
+    def hestonVariance(self, v0, kappa, theta, sigma, step, path, seed = None):
+        dt = 1/365
+        rng = np.random.RandomState(seed)
+
+        vt = np.full(path, float(v0))
+        V = np.zeros(path)
+        I = np.zeros(path)
         for t in range(1, step):
-            vt[:, t] = np.maximum(vt[:, t-1] + kappa*(theta - vt[:, t-1])*dt + sigma*np.sqrt(np.abs(vt[:, t-1])*dt)*W_v[:, t], 0)
-            St[:, t] = St[:, t-1] + mu*St[:, t-1]*dt + np.sqrt(np.abs(vt[:, t-1])*dt)*St[:, t-1]*W_S[:, t]
-        return St
+            W_v = rng.standard_normal(path)
+            sqrt_vdt = np.sqrt(np.abs(vt)*dt)
+            V += sqrt_vdt*sqrt_vdt
+            I += sqrt_vdt*W_v
+            vt = np.maximum(vt + kappa*(theta - vt)*dt + sigma*sqrt_vdt*W_v, 0)
+        return V, I
+
+    # Conditional Monte Carlo digital (Romano-Touzi), undiscounted value, delta and gamma of each path
+    ## Given the variance path, log S_T is normal with mean log S0 + mu*T - V/2 + rho*I and variance (1 - rho^2)*V,
+    ## so P(S_T > K) = N(d) in closed form: smooth in S0, with pathwise delta and gamma
+    def conditionalDigital(self, callPut, S0, mu, v0, kappa, theta, sigma, rho, step, strike, path, seed = None):
+        V, I = self.hestonVariance(v0, kappa, theta, sigma, step, path, seed)
+        s = np.sqrt(np.maximum((1 - rho**2)*V, 1e-300))
+        d = (np.log(S0/strike) + mu*(step - 1)/365 - V/2 + rho*I)/s
+        sign = 1 if callPut == 'Call' else -1
+        density = ImpliedVolatility.normPdf(d)
+        value = ImpliedVolatility.normCdf(sign*d)
+        delta = sign*density/(s*S0)
+        gamma = -sign*density*(d/s + 1)/(s*S0**2)
+        return value, delta, gamma
+
+    # Longstaff-Schwartz, discounted value of each path under the estimated exercise policy
+    ## exerciseSteps: days of the exercise dates in increasing order, the last one is the maturity;
+    ## day d is observed at t = d - 1 as the maturities of hestonSteps, day 0 (the valuation date) at t = 0
+    ## discounts: discount factor of each exercise date
+    ## Only the spot and variance at the exercise dates are kept, (path, dates) each; with a pathStore
+    ## those columns are read from the stored paths, nothing else is copied
+    ## Backward over the exercise dates, one least squares fit over the in-the-money paths of each date
+    ## on the basis 1, x, x^2, v, x*v with x = S/K
+    def leastSquaresPayoffs(self, callPut, S0, mu, v0, kappa, theta, sigma, rho, exerciseSteps, discounts, strike, path, seed = None, pathStore = None):
+        observe = [max(step - 1, 0) for step in exerciseSteps]
+        length = observe[-1] + 1
+        if pathStore is None:
+            S = np.empty((path, len(observe)))
+            v = np.empty((path, len(observe)))
+            column = {}
+            for j, t in enumerate(observe):
+                column.setdefault(t, []).append(j)
+            for t, (St, vt) in enumerate(self.hestonSteps(S0, mu, v0, kappa, theta, sigma, rho, length, path, seed)):
+                for j in column.get(t, ()):
+                    S[:, j] = St
+                    v[:, j] = vt
+        else:
+            storedS, storedv = pathStore.paths(self, (S0, mu, v0, kappa, theta, sigma, rho), length, path, seed, variance = True)
+            S = storedS[:, observe]
+            v = storedv[:, observe]
+
+        sign = 1 if callPut == 'Call' else -1
+        value = np.maximum(sign*(S[:, -1] - strike), 0)*discounts[-1]
+        for j in range(len(observe) - 2, -1, -1):
+            exercise = np.maximum(sign*(S[:, j] - strike), 0)*discounts[j]
+            itm = np.flatnonzero(exercise > 0)
+            if len(itm) < 5:
+                continue
+            x = S[itm, j]/strike
+            vj = v[itm, j]
+            basis = np.stack([np.ones_like(x), x, x*x, vj, x*vj], axis = 1)
+            coefficients = np.linalg.lstsq(basis, value[itm], rcond = None)[0]
+            exercised = itm[exercise[itm] > basis @ coefficients]
+            value[exercised] = exercise[exercised]
+        return value
+
+    # Simulate batches until the standard error target or the time budget is reached
+    ## sampler(path, seed) returns the discounted payoff of each path
+    ## relError is relative to the running estimate, timeBudget in seconds
+    ## callback(MCResult) is called with the running estimate after each batch, e.g. for a live convergence chart
+    def adaptiveSimulation(self, sampler, absError = None, relError = None, timeBudget = None, batch = 5000, maxPath = 2000000, confidence = 0.95, seed = None, callback = None):
+        if absError is None and relError is None and timeBudget is None:
+            raise ValueError('Adaptive simulation needs absError, relError or timeBudget')
+        rng = np.random.RandomState(seed)
+        z = NormalDist().inv_cdf(0.5 + confidence/2)
+        start = time.perf_counter()
+
+        # Running mean and sum of squared deviations, merged batch by batch
+        n = 0; mean = 0.0; M2 = 0.0
+        while True:
+            value = sampler(batch, rng.randint(2**31 - 1))
+            batchMean = value.mean()
+            delta = batchMean - mean
+            mean += delta*batch/(n + batch)
+            M2 += ((value - batchMean)**2).sum() + delta**2*n*batch/(n + batch)
+            n += batch
+
+            standardError = np.sqrt(M2/(n - 1)/n)
+            if callback is not None:
+                callback(MCResult(mean, mean - z*standardError, mean + z*standardError, standardError, n))
+            # No variance yet (e.g. no path has reached a far strike), the estimate cannot be trusted
+            if standardError > 0:
+                if absError is not None and standardError <= absError:
+                    break
+                if relError is not None and standardError <= relError*abs(mean):
+                    break
+            if timeBudget is not None and time.perf_counter() - start >= timeBudget:
+                break
+            if n >= maxPath:
+                break
+        return MCResult(mean, mean - z*standardError, mean + z*standardError, standardError, n)
 
 class VanillaOptionSimulation(Calibration):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, calibration = None):
+        super().__init__(calibration = calibration)
         
-        self.HestonProcess = ql.HestonProcess(self.zero_curve_ts, self.dividend_ts, ql.QuoteHandle(ql.SimpleQuote(self.spot)), self.v0, self.kappa, self.theta, self.sigma, self.rho)
-        self.HestonModel = ql.HestonModel(self.HestonProcess)
-        self.AHE = ql.AnalyticHestonEngine(self.HestonModel)
+        with self.evaluation():
+            self.HestonProcess = ql.HestonProcess(self.zero_curve_ts, self.dividend_ts, ql.QuoteHandle(ql.SimpleQuote(self.spot)), self.v0, self.kappa, self.theta, self.sigma, self.rho)
+            self.HestonModel = ql.HestonModel(self.HestonProcess)
+            self.AHE = ql.AnalyticHestonEngine(self.HestonModel)
         
     def callNPV(self, maturity, strike):
-        year = int(maturity[0:4])
-        month = int(maturity[5:7])
-        day = int(maturity[8:10])
-        maturity = ql.Date(day, month, year)
+        maturity, step, discount_rate = self.maturitySchedule(maturity)
         europeanExer = ql.EuropeanExercise(maturity)
         vanillaPayoff = ql.PlainVanillaPayoff(ql.Option.Call, strike)
         anEuroOption = ql.EuropeanOption(vanillaPayoff, europeanExer)
         anEuroOption.setPricingEngine(self.AHE)
-        return anEuroOption.NPV()
+        with self.evaluation():
+            return anEuroOption.NPV()
     
     def putNPV(self, maturity, strike):
-        year = int(maturity[0:4])
-        month = int(maturity[5:7])
-        day = int(maturity[8:10])
-        maturity = ql.Date(day, month, year)
+        maturity, step, discount_rate = self.maturitySchedule(maturity)
         europeanExer = ql.EuropeanExercise(maturity)
         vanillaPayoff = ql.PlainVanillaPayoff(ql.Option.Put, strike)
         anEuroOption = ql.EuropeanOption(vanillaPayoff, europeanExer)
         anEuroOption.setPricingEngine(self.AHE)
-        return anEuroOption.NPV()
+        with self.evaluation():
+            return anEuroOption.NPV()
     
+# Cash-or-nothing digitals paying 1, every NPV is discounted
 class DigitalOptionSimulation(Calibration, MonteCarloSimulation):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, calibration = None):
+        super().__init__(calibration = calibration)
     
-    def callNPV(self, maturity, strike, path = 20000):
-        year = int(maturity[0:4])
-        month = int(maturity[5:7])
-        day = int(maturity[8:10])
-        maturity = ql.Date(day, month, year)
-        step = maturity - self.calculation_date
-        S = self.hestonModel(self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho, step, path)
-        NPV = sum(S[:, -1] > strike)/path
+    def callNPV(self, maturity, strike, path = 20000, seed = None, pathStore = None):
+        maturity, step, discount_rate = self.maturitySchedule(maturity)
+        payoff = Payoff.DigitalPayoff('Call', strike)
+        value, = self.hestonPayoffs(self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho, step, path, [payoff], seed, pathStore)
+        NPV = value.mean()*discount_rate
         return NPV
     
-    def putNPV(self, maturity, strike, path = 20000):
-        year = int(maturity[0:4])
-        month = int(maturity[5:7])
-        day = int(maturity[8:10])
-        maturity = ql.Date(day, month, year)
-        step = maturity - self.calculation_date
-        S = self.hestonModel(self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho, step, path)
-        NPV = sum(S[:, -1] < strike)/path
+    def putNPV(self, maturity, strike, path = 20000, seed = None, pathStore = None):
+        maturity, step, discount_rate = self.maturitySchedule(maturity)
+        payoff = Payoff.DigitalPayoff('Put', strike)
+        value, = self.hestonPayoffs(self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho, step, path, [payoff], seed, pathStore)
+        NPV = value.mean()*discount_rate
         return NPV
+    
+    # Conditional Monte Carlo, returns DigitalResult
+    ## Far lower variance than counting the paths above the strike: a few thousand paths are enough
+    def callNPVConditional(self, maturity, strike, path = 2000, seed = None):
+        maturity, step, discount_rate = self.maturitySchedule(maturity)
+        value, delta, gamma = self.conditionalDigital('Call', self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho, step, strike, path, seed)
+        return DigitalResult(value.mean()*discount_rate, value.std()/np.sqrt(path)*discount_rate, delta.mean()*discount_rate, gamma.mean()*discount_rate, path)
 
-class BarrierOptionSimulation(Calibration, MonteCarloSimulation):
-    def __init__(self):
-        super().__init__()
+    def putNPVConditional(self, maturity, strike, path = 2000, seed = None):
+        maturity, step, discount_rate = self.maturitySchedule(maturity)
+        value, delta, gamma = self.conditionalDigital('Put', self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho, step, strike, path, seed)
+        return DigitalResult(value.mean()*discount_rate, value.std()/np.sqrt(path)*discount_rate, delta.mean()*discount_rate, gamma.mean()*discount_rate, path)
 
-    def downoutCallNPV(self, maturity, strike, downBarrier, path = 20000):
-        year = int(maturity[0:4])
-        month = int(maturity[5:7])
-        day = int(maturity[8:10])
-        maturity = ql.Date(day, month, year)
-        step = maturity - self.calculation_date
-        T = step/365
-        r = self.zero_curve_ts.zeroRate(maturity, self.day_count, ql.Continuous).rate()
-        discount_rate = np.exp(-r*T)
+    # Adaptive path count, returns MCResult
+    def callNPVAdaptive(self, maturity, strike, absError = None, relError = None, timeBudget = None, batch = 5000, seed = None):
+        maturity, step, discount_rate = self.maturitySchedule(maturity)
+        payoff = Payoff.DigitalPayoff('Call', strike)
+        sampler = lambda path, seed: self.hestonPayoffs(self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho, step, path, [payoff], seed)[0]*discount_rate
+        return self.adaptiveSimulation(sampler, absError, relError, timeBudget, batch, seed = seed)
+    
+    def putNPVAdaptive(self, maturity, strike, absError = None, relError = None, timeBudget = None, batch = 5000, seed = None):
+        maturity, step, discount_rate = self.maturitySchedule(maturity)
+        payoff = Payoff.DigitalPayoff('Put', strike)
+        sampler = lambda path, seed: self.hestonPayoffs(self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho, step, path, [payoff], seed)[0]*discount_rate
+        return self.adaptiveSimulation(sampler, absError, relError, timeBudget, batch, seed = seed)
 
-        S = self.hestonModel(self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho, step, path)
-        
-        bool = np.sum(S > downBarrier, axis = 1)
-        S = S[np.where(bool == step)]
-        bool = S[:, -1] > strike
-        NPV = sum((S[np.where(bool == True)][:, -1] - strike)*discount_rate)/path
+class BarrierOptionSimulation(Calibration, MonteCarloSimulation):
+    def __init__(self, calibration = None):
+        super().__init__(calibration = calibration)
+
+    def downoutCallNPV(self, maturity, strike, downBarrier, path = 20000, seed = None, pathStore = None):
+        maturity, step, discount_rate = self.maturitySchedule(maturity)
+        payoff = Payoff.BarrierPayoff('Call', strike, downBarrier = downBarrier)
+        value, = self.hestonPayoffs(self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho, step, path, [payoff], seed, pathStore)
+        NPV = value.mean()*discount_rate
         return NPV
     
-    def downoutPutNPV(self, maturity, strike, downBarrier, path = 20000):
-        year = int(maturity[0:4])
-        month = int(maturity[5:7])
-        day = int(maturity[8:10])
-        maturity = ql.Date(day, month, year)
-        step = maturity - self.calculation_date
-        T = step/365
-        r = self.zero_curve_ts.zeroRate(maturity, self.day_count, ql.Continuous).rate()
-        discount_rate = np.exp(-r*T)
+    def downoutPutNPV(self, maturity, strike, downBarrier, path = 20000, seed = None, pathStore = None):
+        maturity, step, discount_rate = self.maturitySchedule(maturity)
+        payoff = Payoff.BarrierPayoff('Put', strike, downBarrier = downBarrier)
+        value, = self.hestonPayoffs(self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho, step, path, [payoff], seed, pathStore)
+        NPV = value.mean()*discount_rate
+        return NPV
+    
+    # Adaptive path count, returns MCResult
+    def downoutCallNPVAdaptive(self, maturity, strike, downBarrier, absError = None, relError = None, timeBudget = None, batch = 5000, seed = None):
+        maturity, step, discount_rate = self.maturitySchedule(maturity)
+        payoff = Payoff.BarrierPayoff('Call', strike, downBarrier = downBarrier)
+        sampler = lambda path, seed: self.hestonPayoffs(self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho, step, path, [payoff], seed)[0]*discount_rate
+        return self.adaptiveSimulation(sampler, absError, relError, timeBudget, batch, seed = seed)
+    
+    def downoutPutNPVAdaptive(self, maturity, strike, downBarrier, absError = None, relError = None, timeBudget = None, batch = 5000, seed = None):
+        maturity, step, discount_rate = self.maturitySchedule(maturity)
+        payoff = Payoff.BarrierPayoff('Put', strike, downBarrier = downBarrier)
+        sampler = lambda path, seed: self.hestonPayoffs(self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho, step, path, [payoff], seed)[0]*discount_rate
+        return self.adaptiveSimulation(sampler, absError, relError, timeBudget, batch, seed = seed)
 
-        S = self.hestonModel(self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho, step, path)
-        
-        bool = np.sum(S > downBarrier, axis = 1)
-        S = S[np.where(bool == step)]
-        bool = S[:, -1] < strike
-        NPV = sum(np.abs(strike - S[np.where(bool == True)][:, -1])*discount_rate)/path
+# Any Payoff definitions priced together on one set of paths
+class ExoticOptionSimulation(Calibration, MonteCarloSimulation):
+    def __init__(self, calibration = None):
+        super().__init__(calibration = calibration)
+
+    def NPV(self, maturity, payoffs, path = 20000, seed = None, pathStore = None):
+        maturity, step, discount_rate = self.maturitySchedule(maturity)
+        values = self.hestonPayoffs(self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho, step, path, payoffs, seed, pathStore)
+        NPV = [value.mean()*discount_rate for value in values]
         return NPV
 
-class RateData():
-    def __init__(self):
-        day_count = ql.Actual365Fixed()
-        calendar  = ql.NullCalendar()
+# American and Bermudan vanilla options by least squares Monte Carlo (Longstaff-Schwartz)
+## exerciseDates: 'YYYY-MM-DD' exercise dates, otherwise every exerciseFrequency days; the maturity is always one
+## An exercise date every day approximates an American option
+class AmericanOptionSimulation(Calibration, MonteCarloSimulation):
+    def __init__(self, calibration = None):
+        super().__init__(calibration = calibration)
 
-        calculation_date = ql.Date(22, 11, 2021)
-        spot = 57407.27
+    def callNPV(self, maturity, strike, exerciseDates = None, exerciseFrequency = 7, path = 20000, seed = None, pathStore = None):
+        exerciseSteps, discounts = self.exerciseSchedule(maturity, exerciseDates, exerciseFrequency)
+        value = self.leastSquaresPayoffs('Call', self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho,
+                                         exerciseSteps, discounts, strike, path, seed, pathStore)
+        NPV = value.mean()
+        return NPV
 
-        ql.Settings.instance().evaluationDate = calculation_date
+    def putNPV(self, maturity, strike, exerciseDates = None, exerciseFrequency = 7, path = 20000, seed = None, pathStore = None):
+        exerciseSteps, discounts = self.exerciseSchedule(maturity, exerciseDates, exerciseFrequency)
+        value = self.leastSquaresPayoffs('Put', self.spot, self.dividend_rate, self.v0, self.kappa, self.theta, self.sigma, self.rho,
+                                         exerciseSteps, discounts, strike, path, seed, pathStore)
+        NPV = value.mean()
+        return NPV
 
-        risk_free_rate = [0.00091249886, 0.00091249886, 0.00141713916, 0.00178991217, 0.00308713517] # 2021/11/02 0D 1D 3M 6M 12M
-        risk_free_rate_date = [ql.Date(22, 11, 2021), ql.Date(23, 11, 2021), ql.Date(23, 2, 2022), ql.Date(23, 5, 2022), ql.Date(23, 11, 2022)]
-        self.zero_curve_ts = ql.YieldTermStructureHandle(ql.ZeroCurve(risk_free_rate_date, risk_free_rate, day_count, calendar))
+    # Days to each exercise date up to the maturity and their discount factors
+    def exerciseSchedule(self, maturity, exerciseDates, exerciseFrequency):
+        maturity, step, discount_rate = self.maturitySchedule(maturity)
+        if exerciseDates is None:
+            exerciseSteps = list(range(exerciseFrequency, step, exerciseFrequency))
+        else:
+            exerciseSteps = [self.maturitySchedule(date)[1] for date in exerciseDates]
+        exerciseSteps = sorted(set(exerciseStep for exerciseStep in exerciseSteps if 0 < exerciseStep < step)) + [step]
+        with self.evaluation():
+            discounts = np.array([self.zero_curve_ts.discount(self.calculation_date + exerciseStep) for exerciseStep in exerciseSteps])
+        return exerciseSteps, discounts
+
+class RateData(PricingContext):
+    def __init__(self, calculation_date = None):
+        super().__init__(calculation_date)
+    
+    def getCurveDates(self, time = 1):
+        return [str((self.calculation_date + ql.Period(i, ql.Months)).to_date()) for i in range(time*12 + 1)]
     
     def getZeroCurve(self, time = 1):
         zeroCurve = []
-        for i in range(time*12 + 1):
-            zeroCurve.append(self.zero_curve_ts.zeroRate(i/12, ql.Compounded, ql.Annual).rate())
+        with self.evaluation():
+            for i in range(time*12 + 1):
+                zeroCurve.append(self.zero_curve_ts.zeroRate(i/12, ql.Compounded, ql.Annual).rate())
         return zeroCurve
         
     def getDiscountCurve(self, time = 1):
         discountCurve = []
-        for i in range(time*12 + 1):
-            discountCurve.append(self.zero_curve_ts.discount(i/12))
+        with self.evaluation():
+            for i in range(time*12 + 1):
+                discountCurve.append(self.zero_curve_ts.discount(i/12))
         return discountCurve
\ No newline at end of file
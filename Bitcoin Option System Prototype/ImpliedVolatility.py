@@ -0,0 +1,120 @@
+from datetime import datetime
+
+import numpy as np
+
+# Standard normal pdf and cdf on arrays
+## cdf from the complementary error function of Numerical Recipes (erfcc), fractional error < 1.2e-7
+def normPdf(x):
+    return np.exp(-0.5*x*x)/np.sqrt(2*np.pi)
+
+def normCdf(x):
+    z = np.abs(x)/np.sqrt(2)
+    t = 1/(1 + 0.5*z)
+    erfc = t*np.exp(-z*z - 1.26551223 + t*(1.00002368 + t*(0.37409196 + t*(0.09678418 + t*(-0.18628806 + t*(0.27886807 + t*(-1.13520398 +
+           t*(1.48851587 + t*(-0.82215223 + t*0.17087277)))))))))
+    return np.where(x >= 0, 1 - 0.5*erfc, 0.5*erfc)
+
+# Black-76 price in units of the forward (BTC-denominated premium)
+## Deribit quotes premiums in BTC: USD premium / underlying = D*(F*N(d1) - K*N(d2)) / (D*F) = N(d1) - K/F*N(d2)
+## so the discount factor cancels and only the forward is needed
+def black76(forward, strike, T, vol, isCall):
+    k = np.asarray(strike, dtype = float)/forward
+    s = np.asarray(vol, dtype = float)*np.sqrt(T)
+    d1 = -np.log(k)/s + s/2
+    call = normCdf(d1) - k*normCdf(d1 - s)
+    put = k*normCdf(s - d1) - normCdf(-d1)
+    return np.where(isCall, call, put)
+
+# Implied volatility of BTC-denominated premiums, all quotes solved at once
+## Newton on the total volatility s = vol*sqrt(T) inside a bracket kept per quote;
+## a step leaving the bracket (or with a vanishing vega) falls back to bisection
+## Solved on the out-of-the-money side (time value) to avoid cancellation for deep in-the-money quotes
+## Prices outside the no-arbitrage bounds, or not positive, give NaN
+def impliedVolatility(price, forward, strike, T, isCall, tol = 1e-8, maxIter = 100):
+    price, forward, strike, T, isCall = np.broadcast_arrays(np.asarray(price, dtype = float), np.asarray(forward, dtype = float),
+                                                            np.asarray(strike, dtype = float), np.asarray(T, dtype = float), np.asarray(isCall, dtype = bool))
+    k = strike/forward
+    # Puts through put-call parity in forward units: C - P = 1 - K/F
+    c = np.where(isCall, price, price + 1 - k)
+    intrinsic = np.maximum(1 - k, 0)
+    valid = (price > 0) & (T > 0) & (forward > 0) & (c > intrinsic) & (c < 1)
+
+    vol = np.full(price.shape, np.nan)
+    if not valid.any():
+        return vol
+    timeValue = (c - intrinsic)[valid]; k = k[valid]; logk = np.log(k)
+    c = c[valid]; otmCall = k >= 1
+
+    # Initial guess, Corrado-Miller approximation, then bracket [lo, hi] of the total volatility
+    x = c - (1 - k)/2
+    s = np.sqrt(2*np.pi)/(1 + k)*(x + np.sqrt(np.maximum(x*x - (1 - k)**2/np.pi, 0)))
+    s = np.clip(np.where(np.isfinite(s), s, 0.5), 1e-4, 10)
+    lo = np.zeros_like(s)
+    hi = np.full_like(s, 20.0)
+
+    active = np.ones(s.shape, dtype = bool)
+    for i in range(maxIter):
+        si = s[active]
+        d1 = -logk[active]/si + si/2
+        ka = k[active]
+        model = np.where(otmCall[active], normCdf(d1) - ka*normCdf(d1 - si), ka*normCdf(si - d1) - normCdf(-d1))
+        diff = model - timeValue[active]
+        vega = normPdf(d1)
+
+        # Update the bracket, the price is increasing in s
+        above = diff > 0
+        hi[active] = np.where(above, si, hi[active])
+        lo[active] = np.where(above, lo[active], si)
+
+        done = np.abs(diff) < tol*np.maximum(timeValue[active], 1e-4)
+        step = si - diff/np.maximum(vega, 1e-300)
+        inside = (vega > 1e-12) & (step >= lo[active]) & (step <= hi[active])
+        s[active] = np.where(done, si, np.where(inside, step, (lo[active] + hi[active])/2))
+
+        index = np.flatnonzero(active)
+        active[index[done]] = False
+        if not active.any():
+            break
+
+    vol[valid] = s/np.sqrt(T[valid])
+    return vol
+
+# Forward of each expiry from put-call parity of the mark prices, C - P = 1 - K/F in BTC
+## The median over the strikes closest to the money, where both mark prices are positive
+def impliedForwards(maturity, strike, isCall, markPrice, nearest = 3):
+    forwards = {}
+    for expiry in np.unique(maturity):
+        index = maturity == expiry
+        calls = dict(zip(strike[index & isCall], markPrice[index & isCall]))
+        puts = dict(zip(strike[index & ~isCall], markPrice[index & ~isCall]))
+        pairs = [(K, calls[K] - puts[K]) for K in calls if K in puts and calls[K] > 0 and puts[K] > 0 and calls[K] - puts[K] < 1]
+        if not pairs:
+            continue
+        pairs.sort(key = lambda pair: abs(pair[1]))
+        forwards[expiry] = float(np.median([K/(1 - cp) for K, cp in pairs[:nearest]]))
+    return forwards
+
+# Implied volatilities (in %, as the iv columns of btcOptionsData.csv) of a whole option chain
+## df: btcOptionsData.csv layout, valuationTime: snapshot time, expiries at 08:00 UTC
+## Bid and ask quotes that are zero or crossed are masked to NaN
+def chainImpliedVolatility(df, valuationTime = datetime(2022, 5, 19, 1, 30), forwards = None,
+                           priceColumns = ('best_bid_price', 'mark_price', 'best_ask_price')):
+    maturity = df['maturity'].to_numpy().astype(str)
+    strike = df['strike'].to_numpy(dtype = float)
+    isCall = df['option_type'].to_numpy() == 'C'
+
+    if forwards is None:
+        forwards = impliedForwards(maturity, strike, isCall, df['mark_price'].to_numpy(dtype = float))
+    forward = np.array([forwards.get(expiry, np.nan) for expiry in maturity])
+
+    expiryTime = {expiry: datetime.strptime(expiry, '%Y-%m-%d').replace(hour = 8) for expiry in np.unique(maturity)}
+    T = np.array([(expiryTime[expiry] - valuationTime).total_seconds()/(365*24*3600) for expiry in maturity])
+
+    prices = {column: df[column].to_numpy(dtype = float).copy() for column in priceColumns}
+    if 'best_bid_price' in prices and 'best_ask_price' in prices:
+        crossed = (prices['best_bid_price'] > prices['best_ask_price']) & (prices['best_ask_price'] > 0)
+        prices['best_bid_price'][crossed] = np.nan
+        prices['best_ask_price'][crossed] = np.nan
+
+    ivs = {column: impliedVolatility(price, forward, strike, T, isCall)*100 for column, price in prices.items()}
+    return ivs, forwards
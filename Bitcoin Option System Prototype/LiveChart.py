@@ -0,0 +1,147 @@
+import numpy as np
+
+from PyQt5.QtCore import QTimer
+from PyQt5.QtGui import QGuiApplication
+from matplotlib.figure import Figure
+from matplotlib.patches import Polygon
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+
+# Matplotlib chart panel redrawn incrementally
+## Axes, ticks and labels are drawn once and kept as a background; the data artists are animated,
+## an update changes their data (set_data) and only they are blitted over the background
+## Updates are coalesced: changed() only schedules a redraw, at most one per screen refresh
+## The whole figure is redrawn only when the view has to grow (or shrink, for fit(exact = True))
+class LiveChart(FigureCanvas):
+    def __init__(self, parent = None, figsize = (7, 4)):
+        super().__init__(Figure(figsize = figsize, tight_layout = True))
+        self.setParent(parent)
+        self.artists = []
+        self.background = None
+        self.rescale = False
+
+        screen = QGuiApplication.primaryScreen()
+        refreshRate = screen.refreshRate() if screen is not None and screen.refreshRate() > 0 else 60
+        self.timer = QTimer(self)
+        self.timer.setInterval(int(1000/refreshRate))
+        self.timer.timeout.connect(self.flush)
+        self.mpl_connect('draw_event', self.onDraw)
+
+    def addArtist(self, artist):
+        artist.set_animated(True)
+        self.artists.append(artist)
+        return artist
+
+    # Grow the view of ax to the data with a margin, exact: fit the view to the data
+    def fit(self, ax, x, y, margin = 0.1, exact = False):
+        x = np.asarray(x, dtype = float); y = np.asarray(y, dtype = float)
+        x = x[np.isfinite(x)]; y = y[np.isfinite(y)]
+        if len(x) == 0 or len(y) == 0:
+            return
+        limits = []
+        for (low, high), data in ((ax.get_xlim(), x), (ax.get_ylim(), y)):
+            if not exact and low <= data.min() and data.max() <= high:
+                limits.append((low, high))
+                continue
+            pad = (data.max() - data.min())*margin or abs(data.max())*margin or 1.0
+            limits.append((data.min() - pad, data.max() + pad))
+        if limits != [ax.get_xlim(), ax.get_ylim()]:
+            ax.set_xlim(*limits[0])
+            ax.set_ylim(*limits[1])
+            self.rescale = True
+
+    # Data of the artists changed, redraw at the next refresh
+    def changed(self):
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def flush(self):
+        self.timer.stop()
+        if self.rescale or self.background is None:
+            self.rescale = False
+            self.draw_idle()
+            return
+        self.restore_region(self.background)
+        for artist in self.artists:
+            artist.axes.draw_artist(artist)
+        self.blit(self.figure.bbox)
+
+    # After a full draw, keep the new background and draw the artists on it
+    def onDraw(self, event):
+        self.background = self.copy_from_bbox(self.figure.bbox)
+        for artist in self.artists:
+            artist.axes.draw_artist(artist)
+
+# Market and model implied volatility smile of one maturity
+class SmileChart(LiveChart):
+    def __init__(self, parent = None):
+        super().__init__(parent)
+        self.ax = self.figure.add_subplot()
+        self.ax.set_xlabel('Strike')
+        self.ax.set_ylabel('Implied volatility (%)')
+        self.ax.grid(True, alpha = 0.3)
+        self.market, = self.ax.plot([], [], 'o', color = 'b', markersize = 4, label = 'Market (mark)')
+        self.model, = self.ax.plot([], [], '-', color = 'r', label = 'Model (SVI)')
+        self.title = self.ax.text(0.5, 1.02, '', transform = self.ax.transAxes, ha = 'center')
+        self.ax.legend(loc = 'upper right')
+        for artist in (self.market, self.model, self.title):
+            self.addArtist(artist)
+
+    def setSmile(self, title, strikes, marketVol, modelStrikes, modelVol):
+        self.market.set_data(strikes, marketVol)
+        self.model.set_data(modelStrikes, modelVol)
+        self.title.set_text(title)
+        self.fit(self.ax, np.concatenate([strikes, modelStrikes]), np.concatenate([marketVol, modelVol]), exact = True)
+        self.changed()
+
+# Running Monte Carlo estimate with its confidence band, one point per batch
+class ConvergenceChart(LiveChart):
+    def __init__(self, parent = None):
+        super().__init__(parent)
+        self.ax = self.figure.add_subplot()
+        self.ax.set_xlabel('Paths')
+        self.ax.set_ylabel('NPV')
+        self.ax.grid(True, alpha = 0.3)
+        self.band = self.ax.add_patch(Polygon(np.zeros((0, 2)), closed = True, color = 'b', alpha = 0.2, linewidth = 0))
+        self.estimate, = self.ax.plot([], [], '-', color = 'b')
+        self.title = self.ax.text(0.5, 1.02, '', transform = self.ax.transAxes, ha = 'center')
+        for artist in (self.band, self.estimate, self.title):
+            self.addArtist(artist)
+        self.reset('')
+
+    def reset(self, title):
+        self.path = []; self.NPV = []; self.lower = []; self.upper = []
+        self.title.set_text(title)
+        self.estimate.set_data([], [])
+        self.band.set_xy(np.zeros((0, 2)))
+        self.changed()
+
+    # result: HestonModel.MCResult
+    def addPoint(self, result):
+        self.path.append(result.path); self.NPV.append(result.NPV)
+        self.lower.append(result.lower); self.upper.append(result.upper)
+        self.estimate.set_data(self.path, self.NPV)
+        self.band.set_xy(np.column_stack([self.path + self.path[::-1], self.upper + self.lower[::-1]]))
+        self.title.set_text('NPV %.4f ± %.4f, %d paths' % (result.NPV, result.upper - result.NPV, result.path))
+        # The band narrows, only the first points decide the vertical range
+        self.fit(self.ax, [0, 2*result.path], self.lower[:3] + self.upper[:3], margin = 0.05)
+        self.changed()
+
+# Relative price error of each calibration helper
+class CalibrationErrorChart(LiveChart):
+    def __init__(self, parent = None):
+        super().__init__(parent)
+        self.ax = self.figure.add_subplot()
+        self.ax.set_xlabel('Strike')
+        self.ax.set_ylabel('Relative price error (%)')
+        self.ax.axhline(0, color = 'k', linewidth = 0.8)
+        self.ax.grid(True, alpha = 0.3)
+        self.errors, = self.ax.plot([], [], 'o-', color = 'g')
+        self.title = self.ax.text(0.5, 1.02, 'Calibrating ...', transform = self.ax.transAxes, ha = 'center')
+        for artist in (self.errors, self.title):
+            self.addArtist(artist)
+
+    def setErrors(self, title, strikes, errors):
+        self.errors.set_data(strikes, errors)
+        self.title.set_text(title)
+        self.fit(self.ax, strikes, np.concatenate([errors, [0]]), exact = True)
+        self.changed()
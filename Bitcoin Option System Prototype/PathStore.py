@@ -0,0 +1,180 @@
+import os
+import shutil
+import itertools
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Simulated Heston path sets kept in memory-mapped files
+## Key   : model params (S0, mu, v0, kappa, theta, sigma, rho), path count, seed, scheme, with or without variance
+## Entry : spots (path, step) float64, or spots and variances (2, path, step), one row per path so that
+##         a block of dates S[:, t0:t1] is a zero-copy view for Payoff.RunningStatistics.update
+## The paths of hestonSteps are drawn date by date, so the first n dates of a longer set are the set of n dates:
+## one entry serves every maturity up to its length, a longer maturity resimulates and replaces it
+## seed = None is a valid key: one random set shared by all contracts while it is cached (common random numbers)
+## Worker processes open an entry from its descriptor (filename, shape) with PathStore.open, read-only and zero-copy;
+## the file of a descriptor outlives the eviction or replacement of its entry until PathStore.release(descriptor)
+## A memory-mapped write past the capacity of a tmpfs kills the process (SIGBUS) instead of raising:
+## maxMemory is clamped to the free space of the directory, and a set that does not fit after eviction
+## is written to a disk-backed temporary directory instead
+class PathStore():
+    def __init__(self, maxMemory = 512*1024*1024, directory = None):
+        self.requestedMemory = maxMemory
+        self.memory = 0
+        self.entries = OrderedDict()
+        self.modelKey = None
+        self.lock = threading.RLock()
+
+        # RAM-backed files when the platform has them
+        self.ownDirectories = []
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix = 'pathStore', dir = '/dev/shm' if os.path.isdir('/dev/shm') else None)
+            self.ownDirectories.append(directory)
+        else:
+            os.makedirs(directory, exist_ok = True)
+        self.setDirectory(directory)
+        self.pending = []
+        self.readers = {}
+        self.fileNumber = itertools.count()
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def setDirectory(self, directory):
+        self.directory = directory
+        self.maxMemory = min(self.requestedMemory, self.freeSpace())
+
+    def freeSpace(self):
+        return shutil.disk_usage(self.directory).free
+
+    @staticmethod
+    def getPathKey(params, path, seed, scheme, variance = False):
+        key = (tuple(float(value) for value in params), path, seed, scheme, variance)
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    # Switch to a new calibration, path sets of the other models are dropped
+    def bind(self, modelKey):
+        with self.lock:
+            if modelKey == self.modelKey:
+                return
+            self.modelKey = modelKey
+            for key in [key for key in self.entries if key[0] != modelKey]:
+                self._remove(key)
+
+    def invalidate(self):
+        with self.lock:
+            for key in list(self.entries):
+                self._remove(key)
+
+    # simulation: a MonteCarloSimulation, params: (S0, mu, v0, kappa, theta, sigma, rho)
+    # Return the spots (path, step), or (spots, variances) with variance = True, as read-only memory maps
+    ## The file is mapped before the lock is released, a mapped file stays readable after its entry is removed
+    def paths(self, simulation, params, step, path, seed = None, variance = False):
+        with self.lock:
+            paths = self.open(self._lookup(simulation, params, step, path, seed, variance))
+        return (paths[0, :, :step], paths[1, :, :step]) if variance else paths[:, :step]
+
+    # Simulate the set if needed and return its (filename, shape) for PathStore.open in another process
+    ## The file is kept until the descriptor is released
+    def descriptor(self, simulation, params, step, path, seed = None, variance = False):
+        with self.lock:
+            descriptor = self._lookup(simulation, params, step, path, seed, variance)
+            self.readers[descriptor[0]] = self.readers.get(descriptor[0], 0) + 1
+            return descriptor
+
+    def release(self, descriptor):
+        with self.lock:
+            self.readers[descriptor[0]] -= 1
+            if self.readers[descriptor[0]] == 0:
+                del self.readers[descriptor[0]]
+            self._removePending()
+
+    # Entry of the set, simulated if needed, called with the lock held
+    def _lookup(self, simulation, params, step, path, seed, variance):
+        key = (self.modelKey, self.getPathKey(params, path, seed, simulation.scheme, variance))
+        if key in self.entries and self.entries[key][1][-1] >= step:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][:2]
+
+        self.misses += 1
+        if key in self.entries:
+            self._remove(key)
+        shape = (2, path, step) if variance else (path, step)
+        size = 8*int(np.prod(shape))
+        self._reserve(size)
+
+        # A new file every time, a released or evicted file of the same set may still be read
+        filename = os.path.join(self.directory, '%s_%d_%d.npy' % (key[1], step, next(self.fileNumber)))
+        paths = np.lib.format.open_memmap(filename, mode = 'w+', dtype = np.float64, shape = shape)
+        stored = paths.reshape((-1, path, step))
+
+        # Dates are buffered and written in blocks, each row of the file is written a few times only
+        block = np.empty((stored.shape[0], path, 64))
+        for t, (St, vt) in enumerate(simulation.hestonSteps(*params, step, path, seed)):
+            block[0, :, t % 64] = St
+            if variance:
+                block[1, :, t % 64] = vt
+            if t % 64 == 63 or t == step - 1:
+                start = t - t % 64
+                stored[:, :, start:t + 1] = block[:, :, :t + 1 - start]
+        paths.flush()
+        del paths, stored
+
+        self.entries[key] = (filename, shape, size)
+        self.memory += size
+        return filename, shape
+
+    @staticmethod
+    def open(descriptor):
+        return np.load(descriptor[0], mmap_mode = 'r')
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hitRate': self.hits/lookups if lookups else 0.0,
+                    'entries': len(self.entries), 'memory': self.memory, 'evictions': self.evictions}
+
+    def close(self):
+        self.invalidate()
+        for directory in self.ownDirectories:
+            shutil.rmtree(directory, ignore_errors = True)
+
+    # Evict the oldest sets until a new set of size bytes fits the budget and the file system (with 1 MB to spare),
+    # move to a disk-backed temporary directory when even an empty store has no room for it
+    def _reserve(self, size):
+        margin = 1024*1024
+        while self.entries and (self.memory + size > self.maxMemory or size + margin > self.freeSpace()):
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+        if size + margin > self.freeSpace() and os.path.dirname(self.directory) != tempfile.gettempdir():
+            directory = tempfile.mkdtemp(prefix = 'pathStore')
+            self.ownDirectories.append(directory)
+            self.setDirectory(directory)
+        if size + margin > self.freeSpace():
+            raise OSError('No space left for a path set of %d bytes in %s' % (size, self.directory))
+
+    # Files still mapped by a reader cannot be deleted on Windows, they are retried on the next removal;
+    # files of unreleased descriptors are kept the same way
+    def _remove(self, key):
+        filename, shape, size = self.entries.pop(key)
+        self.memory -= size
+        self.pending.append(filename)
+        self._removePending()
+
+    def _removePending(self):
+        for filename in list(self.pending):
+            if filename in self.readers:
+                continue
+            try:
+                os.remove(filename)
+                self.pending.remove(filename)
+            except FileNotFoundError:
+                self.pending.remove(filename)
+            except OSError:
+                pass
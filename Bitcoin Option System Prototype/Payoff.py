@@ -0,0 +1,176 @@
+import numpy as np
+
+# Running path statistics
+## 'last'   : spot at the last observation
+## 'sum'    : sum of the observed spots (arithmetic average)
+## 'logSum' : sum of the observed log spots (geometric average)
+## 'min', 'max'
+## ('below', level), ('above', level): whether the path has touched the level
+class RunningStatistics():
+    def __init__(self, statistics, path):
+        self.statistics = set(statistics) | {'last'}
+        self.path = path
+        self.count = 0
+        self.values = {}
+        for name in self.statistics:
+            if name in ('sum', 'logSum'):
+                self.values[name] = np.zeros(path)
+            elif name == 'min':
+                self.values[name] = np.full(path, np.inf)
+            elif name == 'max':
+                self.values[name] = np.full(path, -np.inf)
+            elif name == 'last':
+                self.values[name] = np.zeros(path)
+            elif name[0] in ('below', 'above'):
+                self.values[name] = np.zeros(path, dtype = bool)
+            else:
+                raise ValueError('Unknown path statistic: %s' % (name, ))
+
+    # S: spots of one observation date (path, ) or a block of dates (path, step)
+    def update(self, S):
+        S = S.reshape(self.path, -1)
+        self.count += S.shape[1]
+        for name, value in self.values.items():
+            if name == 'last':
+                value[:] = S[:, -1]
+            elif name == 'sum':
+                value += S.sum(axis = 1)
+            elif name == 'logSum':
+                value += np.log(S).sum(axis = 1)
+            elif name == 'min':
+                np.minimum(value, S.min(axis = 1), out = value)
+            elif name == 'max':
+                np.maximum(value, S.max(axis = 1), out = value)
+            elif name[0] == 'below':
+                value |= (S <= name[1]).any(axis = 1)
+            elif name[0] == 'above':
+                value |= (S >= name[1]).any(axis = 1)
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+def requiredStatistics(payoffs):
+    statistics = set()
+    for payoff in payoffs:
+        statistics |= set(payoff.statistics())
+    return statistics
+
+# Payoff definitions
+## Each payoff declares the running statistics it needs and is valued at maturity from them (undiscounted)
+class Payoff():
+    def __init__(self, callPut, strike):
+        if callPut not in ('Call', 'Put'):
+            raise ValueError('Option type must be Call or Put')
+        self.callPut = callPut
+        self.strike = strike
+
+    def statistics(self):
+        return ('last', )
+
+    def value(self, stats):
+        raise NotImplementedError
+
+    def intrinsic(self, S, strike):
+        if self.callPut == 'Call':
+            return np.maximum(S - strike, 0)
+        return np.maximum(strike - S, 0)
+
+    def __repr__(self):
+        terms = ', '.join('%s=%r' % (key, value) for key, value in self.__dict__.items())
+        return '%s(%s)' % (type(self).__name__, terms)
+
+class VanillaPayoff(Payoff):
+    def value(self, stats):
+        return self.intrinsic(stats['last'], self.strike)
+
+class DigitalPayoff(Payoff):
+    def value(self, stats):
+        if self.callPut == 'Call':
+            return (stats['last'] > self.strike).astype(float)
+        return (stats['last'] < self.strike).astype(float)
+
+class AsianPayoff(Payoff):
+    def __init__(self, callPut, strike, average = 'Arithmetic'):
+        super().__init__(callPut, strike)
+        if average not in ('Arithmetic', 'Geometric'):
+            raise ValueError('Average type must be Arithmetic or Geometric')
+        self.average = average
+
+    def statistics(self):
+        return ('sum', ) if self.average == 'Arithmetic' else ('logSum', )
+
+    def value(self, stats):
+        if self.average == 'Arithmetic':
+            average = stats['sum']/stats.count
+        else:
+            average = np.exp(stats['logSum']/stats.count)
+        return self.intrinsic(average, self.strike)
+
+# Fixed strike: payoff on the extreme against the strike
+# Floating strike (strike = None): payoff on the last spot against the extreme
+class LookbackPayoff(Payoff):
+    def __init__(self, callPut, strike = None):
+        super().__init__(callPut, strike)
+
+    def statistics(self):
+        if self.strike is None:
+            return ('last', 'min') if self.callPut == 'Call' else ('last', 'max')
+        return ('max', ) if self.callPut == 'Call' else ('min', )
+
+    def value(self, stats):
+        if self.strike is None:
+            if self.callPut == 'Call':
+                return stats['last'] - stats['min']
+            return stats['max'] - stats['last']
+        if self.callPut == 'Call':
+            return np.maximum(stats['max'] - self.strike, 0)
+        return np.maximum(self.strike - stats['min'], 0)
+
+# Knock-out: down-out, up-out or double knock-out depending on the barriers given
+class BarrierPayoff(Payoff):
+    def __init__(self, callPut, strike, downBarrier = None, upBarrier = None):
+        super().__init__(callPut, strike)
+        if downBarrier is None and upBarrier is None:
+            raise ValueError('Barrier option needs a down or an up barrier')
+        self.downBarrier = downBarrier
+        self.upBarrier = upBarrier
+
+    def barrierStatistics(self):
+        statistics = ()
+        if self.downBarrier is not None:
+            statistics += (('below', self.downBarrier), )
+        if self.upBarrier is not None:
+            statistics += (('above', self.upBarrier), )
+        return statistics
+
+    def statistics(self):
+        return ('last', ) + self.barrierStatistics()
+
+    def alive(self, stats):
+        alive = np.ones(stats.path, dtype = bool)
+        for name in self.barrierStatistics():
+            alive &= ~stats[name]
+        return alive
+
+    def value(self, stats):
+        return self.intrinsic(stats['last'], self.strike)*self.alive(stats)
+
+# Knock-out cash-or-nothing, pays 1 if the barriers are not hit and the option ends in the money
+class DigitalBarrierPayoff(BarrierPayoff):
+    def value(self, stats):
+        if self.callPut == 'Call':
+            inTheMoney = stats['last'] > self.strike
+        else:
+            inTheMoney = stats['last'] < self.strike
+        return (inTheMoney & self.alive(stats)).astype(float)
+
+# One-touch, pays 1 at maturity if any of the barriers is hit
+class OneTouchPayoff(BarrierPayoff):
+    def __init__(self, downBarrier = None, upBarrier = None):
+        super().__init__('Call', None, downBarrier, upBarrier)
+
+    def statistics(self):
+        return self.barrierStatistics()
+
+    def value(self, stats):
+        return (~self.alive(stats)).astype(float)
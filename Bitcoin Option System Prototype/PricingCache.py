@@ -0,0 +1,132 @@
+import math
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Pricing result cache
+## Memory tier: LRU ordered dict capped by bytes
+## Disk tier  : optional SQLite file shared between sessions
+## Key        : model key (calibrated params + curve + snapshot) and contract key (terms + path + scheme + seed)
+class PricingCache():
+    def __init__(self, maxMemory = 8*1024*1024, diskPath = None):
+        self.maxMemory = maxMemory
+        self.memory = 0
+        self.entries = OrderedDict()
+        self.modelKey = None
+        self.lock = threading.RLock()
+
+        # Metrics
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.savedTime = 0.0
+        self.computeTime = 0.0
+
+        self.disk = None
+        if diskPath is not None:
+            self.disk = sqlite3.connect(diskPath, check_same_thread = False)
+            self.disk.execute('CREATE TABLE IF NOT EXISTS pricing (model TEXT, key TEXT PRIMARY KEY, value BLOB, computeTime REAL)')
+            self.disk.commit()
+
+    # Fingerprint of everything a price depends on besides the contract
+    @staticmethod
+    def getModelKey(calibration):
+        model = (calibration.snapshotId,
+                 tuple(sorted((key, value) for key, value in calibration.params.items() if type(value) != str)),
+                 tuple(calibration.risk_free_rate),
+                 calibration.dividend_rate)
+        return hashlib.sha1(repr(model).encode()).hexdigest()
+
+    @staticmethod
+    def getContractKey(optionType, maturity, strike, callPut, terms = None, path = None, scheme = None, seed = None):
+        contract = (optionType, maturity, float(strike), callPut, terms, path, scheme, seed)
+        return hashlib.sha1(repr(contract).encode()).hexdigest()
+
+    # Switch to a new calibration or curve, entries of the other models are dropped
+    def bind(self, modelKey):
+        with self.lock:
+            if modelKey == self.modelKey:
+                return
+            self.modelKey = modelKey
+            for key in [key for key in self.entries if key[0] != modelKey]:
+                self.memory -= self.entries.pop(key)[2]
+            if self.disk is not None:
+                self.disk.execute('DELETE FROM pricing WHERE model != ?', (modelKey, ))
+                self.disk.commit()
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.memory = 0
+            if self.disk is not None:
+                self.disk.execute('DELETE FROM pricing')
+                self.disk.commit()
+
+    def get(self, contractKey):
+        with self.lock:
+            key = (self.modelKey, contractKey)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                value, computeTime, size = self.entries[key]
+                self.hits += 1
+                self.savedTime += computeTime
+                return value
+
+            if self.disk is not None:
+                row = self.disk.execute('SELECT value, computeTime FROM pricing WHERE model = ? AND key = ?', (self.modelKey, contractKey)).fetchone()
+                if row is not None:
+                    value = pickle.loads(row[0])
+                    self._store(key, value, row[1])
+                    self.diskHits += 1
+                    self.savedTime += row[1]
+                    return value
+
+            self.misses += 1
+            return None
+
+    def put(self, contractKey, value, computeTime = 0.0):
+        with self.lock:
+            self.computeTime += computeTime
+            self._store((self.modelKey, contractKey), value, computeTime)
+            if self.disk is not None:
+                self.disk.execute('INSERT OR REPLACE INTO pricing VALUES (?, ?, ?, ?)', (self.modelKey, contractKey, pickle.dumps(value), computeTime))
+                self.disk.commit()
+
+    # Return the cached value or run the pricer and keep its result, a non-finite price is never cached
+    def price(self, contractKey, pricer):
+        value = self.get(contractKey)
+        if value is not None:
+            return value
+        start = time.perf_counter()
+        value = pricer()
+        if not math.isfinite(value):
+            raise ValueError('Pricer returned a non-finite price: %s' % (value, ))
+        self.put(contractKey, value, time.perf_counter() - start)
+        return value
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.hits + self.diskHits + self.misses
+            return {'hits': self.hits, 'diskHits': self.diskHits, 'misses': self.misses,
+                    'hitRate': (self.hits + self.diskHits)/lookups if lookups else 0.0,
+                    'savedTime': self.savedTime, 'computeTime': self.computeTime,
+                    'entries': len(self.entries), 'memory': self.memory, 'evictions': self.evictions}
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+
+    def _store(self, key, value, computeTime):
+        size = len(pickle.dumps(value)) + len(key[1]) + 128
+        if key in self.entries:
+            self.memory -= self.entries.pop(key)[2]
+        self.entries[key] = (value, computeTime, size)
+        self.memory += size
+        while self.memory > self.maxMemory and len(self.entries) > 1:
+            self.memory -= self.entries.popitem(last = False)[1][2]
+            self.evictions += 1
@@ -0,0 +1,136 @@
+import numpy as np
+
+# Digital and down-out barrier NPVs tabulated over a (maturity x strike x barrier) grid from one shared simulation
+## Digital : NPV[callPut][maturity, strike]           (discounted, as DigitalOptionSimulation.callNPVConditional)
+## Barrier : NPV[callPut][maturity, strike, barrier]  (discounted, as BarrierOptionSimulation)
+## Queries are answered by multilinear interpolation with an error bound:
+## Monte Carlo standard error of the grid nodes + linear interpolation error h^2/8*|f''| along each axis
+class PricingSurface():
+    def __init__(self, modelKey, steps, strikes, barriers, digital, digitalError, barrier, barrierError, path):
+        self.modelKey = modelKey
+        self.steps = np.asarray(steps, dtype = float)
+        self.strikes = np.asarray(strikes, dtype = float)
+        self.barriers = np.asarray(barriers, dtype = float)
+        self.digital = digital
+        self.digitalError = digitalError
+        self.barrier = barrier
+        self.barrierError = barrierError
+        self.path = path
+
+        # Second derivatives of each table along each axis, for the interpolation error bound
+        digitalAxes = (self.steps, self.strikes)
+        barrierAxes = (self.steps, self.strikes, self.barriers)
+        self.digitalCurvature = {callPut: [self._curvature(table, axis, digitalAxes[axis]) for axis in range(2)] for callPut, table in digital.items()}
+        self.barrierCurvature = {callPut: [self._curvature(table, axis, barrierAxes[axis]) for axis in range(3)] for callPut, table in barrier.items()}
+
+    # simulation: a Calibration and MonteCarloSimulation instance, e.g. HestonModel.ExoticOptionSimulation
+    @classmethod
+    def build(cls, simulation, modelKey, maturities, strikes, barriers, path = 20000, seed = None):
+        steps = []; discount = []
+        for maturity in maturities:
+            maturity, step, discount_rate = simulation.maturitySchedule(maturity)
+            steps.append(step)
+            discount.append(discount_rate)
+
+        strikes = np.sort(np.asarray(strikes, dtype = float))
+        barriers = np.sort(np.asarray(barriers, dtype = float))
+        nT, nK, nB = len(steps), len(strikes), len(barriers)
+        digital = {callPut: np.zeros((nT, nK), dtype = np.float32) for callPut in ('Call', 'Put')}
+        digitalError = {callPut: np.zeros((nT, nK), dtype = np.float32) for callPut in ('Call', 'Put')}
+        barrier = {callPut: np.zeros((nT, nK, nB), dtype = np.float32) for callPut in ('Call', 'Put')}
+        barrierError = {callPut: np.zeros((nT, nK, nB), dtype = np.float32) for callPut in ('Call', 'Put')}
+
+        # One simulation up to the last maturity, the maturity of step n is observed at t = n - 1
+        observe = {step - 1: i for i, step in enumerate(steps)}
+        Smin = np.full(path, np.inf)
+        for t, (St, vt) in enumerate(simulation.hestonSteps(simulation.spot, simulation.dividend_rate, simulation.v0, simulation.kappa,
+                                                            simulation.theta, simulation.sigma, simulation.rho, max(steps), path, seed)):
+            np.minimum(Smin, St, out = Smin)
+            if t not in observe:
+                continue
+            i = observe[t]
+
+            # Digital, discounted proportion of paths above / below each strike
+            sortedS = np.sort(St)
+            p = 1 - np.searchsorted(sortedS, strikes, side = 'right')/path
+            q = np.searchsorted(sortedS, strikes, side = 'left')/path
+            digital['Call'][i] = p*discount[i]
+            digital['Put'][i] = q*discount[i]
+            digitalError['Call'][i] = np.sqrt(p*(1 - p)/path)*discount[i]
+            digitalError['Put'][i] = np.sqrt(q*(1 - q)/path)*discount[i]
+
+            # Down-out barrier, knocked out once the spot is at or below the barrier
+            for j, B in enumerate(barriers):
+                alive = (Smin > B)[:, None]
+                for callPut, value in (('Call', np.maximum(St[:, None] - strikes, 0)), ('Put', np.maximum(strikes - St[:, None], 0))):
+                    value = value*alive*discount[i]
+                    barrier[callPut][i, :, j] = value.mean(axis = 0)
+                    barrierError[callPut][i, :, j] = value.std(axis = 0)/np.sqrt(path)
+
+        return cls(modelKey, steps, strikes, barriers, digital, digitalError, barrier, barrierError, path)
+
+    def save(self, filename):
+        tables = {'steps': self.steps, 'strikes': self.strikes, 'barriers': self.barriers, 'path': self.path, 'modelKey': self.modelKey}
+        for callPut in ('Call', 'Put'):
+            tables['digital' + callPut] = self.digital[callPut]
+            tables['digitalError' + callPut] = self.digitalError[callPut]
+            tables['barrier' + callPut] = self.barrier[callPut]
+            tables['barrierError' + callPut] = self.barrierError[callPut]
+        np.savez_compressed(filename, **tables)
+
+    @classmethod
+    def load(cls, filename):
+        tables = np.load(filename)
+        return cls(str(tables['modelKey']), tables['steps'], tables['strikes'], tables['barriers'],
+                   {callPut: tables['digital' + callPut] for callPut in ('Call', 'Put')},
+                   {callPut: tables['digitalError' + callPut] for callPut in ('Call', 'Put')},
+                   {callPut: tables['barrier' + callPut] for callPut in ('Call', 'Put')},
+                   {callPut: tables['barrierError' + callPut] for callPut in ('Call', 'Put')},
+                   int(tables['path']))
+
+    # step: days to maturity, as maturity - calculation_date
+    # Return (NPV, errorBound), None outside of the grid
+    def digitalNPV(self, callPut, step, strike):
+        point = (step, strike)
+        axes = (self.steps, self.strikes)
+        return self._interpolate(axes, point, self.digital[callPut], self.digitalError[callPut], self.digitalCurvature[callPut])
+
+    def downoutNPV(self, callPut, step, strike, downBarrier):
+        point = (step, strike, downBarrier)
+        axes = (self.steps, self.strikes, self.barriers)
+        return self._interpolate(axes, point, self.barrier[callPut], self.barrierError[callPut], self.barrierCurvature[callPut])
+
+    def _interpolate(self, axes, point, table, error, curvature):
+        index = []; weight = []; width = []
+        for axis, x in zip(axes, point):
+            if x < axis[0] or x > axis[-1]:
+                return None
+            i = min(max(np.searchsorted(axis, x, side = 'right') - 1, 0), len(axis) - 2)
+            h = axis[i + 1] - axis[i]
+            index.append(i); weight.append((x - axis[i])/h); width.append(h)
+
+        # Visit the 2^d corners of the cell
+        value = 0.0; mcError = 0.0; interpolationError = 0.0
+        for corner in range(2**len(axes)):
+            node = tuple(index[d] + (corner >> d & 1) for d in range(len(axes)))
+            w = np.prod([weight[d] if corner >> d & 1 else 1 - weight[d] for d in range(len(axes))])
+            value += w*table[node]
+            mcError = max(mcError, error[node])
+        for d in range(len(axes)):
+            cell = tuple(slice(index[k], index[k] + 2) for k in range(len(axes)))
+            interpolationError += width[d]**2/8*np.abs(curvature[d][cell]).max()
+        return float(value), float(mcError + interpolationError)
+
+    # Second derivative along one axis on a non-uniform grid, edge nodes copy their neighbour
+    @staticmethod
+    def _curvature(table, axis, x):
+        table = np.moveaxis(table.astype(float), axis, 0)
+        curvature = np.zeros_like(table)
+        if table.shape[0] >= 3:
+            shape = (-1, ) + (1, )*(table.ndim - 1)
+            hl = np.diff(x)[:-1].reshape(shape)
+            hr = np.diff(x)[1:].reshape(shape)
+            curvature[1:-1] = 2*(hl*table[2:] - (hl + hr)*table[1:-1] + hr*table[:-2])/(hl*hr*(hl + hr))
+            curvature[0] = curvature[1]
+            curvature[-1] = curvature[-2]
+        return np.moveaxis(curvature, 0, axis)
@@ -0,0 +1,264 @@
+from datetime import datetime
+
+import numpy as np
+
+import ImpliedVolatility
+
+# Log-moneyness grid of the static arbitrage checks, widened to the quotes of a slice when they go further
+arbitrageGrid = np.linspace(-1.5, 1.5, 61)
+
+# Raw SVI slice, total variance w(k) = a + b*(rho*(k - m) + sqrt((k - m)^2 + sigma^2)), k = log(K/F)
+class SVISlice():
+    def __init__(self, a, b, rho, m, sigma):
+        self.a = a; self.b = b; self.rho = rho; self.m = m; self.sigma = sigma
+
+    def totalVariance(self, k):
+        x = np.asarray(k) - self.m
+        return self.a + self.b*(self.rho*x + np.sqrt(x*x + self.sigma**2))
+
+    def params(self):
+        return {'a': self.a, 'b': self.b, 'rho': self.rho, 'm': self.m, 'sigma': self.sigma}
+
+    # Static arbitrage of the slice on the log-moneyness grid k: the largest violation, 0 when free of arbitrage
+    ## floor: slice of the previous expiry, the total variance must not decrease in T (calendar spread)
+    def arbitrage(self, k = arbitrageGrid, floor = None):
+        k = np.asarray(k, dtype = float)
+        y = (k - self.m)/self.sigma
+        floorW = None if floor is None else floor.totalVariance(k)
+        return float(self._violation(k, y, np.array([self.a]), np.array([self.rho*self.b*self.sigma]), np.array([self.b*self.sigma]),
+                                     np.array([self.sigma]), floorW)[0])
+
+    # Quasi-explicit fit (Zeliade): for fixed (m, sigma) the slice is linear in (a, d, c),
+    # w = a + d*y + c*sqrt(y^2 + 1), y = (k - m)/sigma, c = b*sigma, d = rho*b*sigma
+    ## (m, sigma) are searched on a grid zoomed around the best candidate, all linear fits solved as one batch
+    ## No-arbitrage constraints: 0 <= c, |d| <= c, c + |d| <= 4*sigma (Lee's moment bound b*(1 + |rho|) <= 4),
+    ## a + b*sigma*sqrt(1 - rho^2) >= 0 (non-negative minimum total variance)
+    ## These are necessary only: candidates are also checked on the arbitrage grid for a non-negative density
+    ## g(k) >= 0 (butterfly) and w(k) >= w of floor, the previous expiry (calendar spread)
+    ## Arbitrage-free candidates beat the others, the fitted slice keeps its violation, 0 when free of arbitrage
+    @classmethod
+    def fit(cls, k, w, weights = None, previous = None, floor = None, grid = 9, rounds = 4):
+        k = np.asarray(k, dtype = float); w = np.asarray(w, dtype = float)
+        weights = np.ones_like(w) if weights is None else np.asarray(weights, dtype = float)
+        kGrid = np.union1d(arbitrageGrid, np.linspace(k.min(), k.max(), 11))
+        floorW = None if floor is None else floor.totalVariance(kGrid)
+
+        # Search window, a warm start from the previous slice begins with a narrow window around it
+        span = max(k.max() - k.min(), 0.1)
+        if previous is not None:
+            mCenter, logSigmaCenter = previous.m, np.log(previous.sigma)
+            mWidth, logSigmaWidth = span/8, 1.0
+            rounds = max(rounds - 2, 1)
+        else:
+            mCenter, logSigmaCenter = k[np.argmin(w)], np.log(span/4)
+            mWidth, logSigmaWidth = span/2, 3.0
+
+        best = None
+        for i in range(rounds):
+            m = mCenter + np.linspace(-mWidth, mWidth, grid)
+            sigma = np.exp(logSigmaCenter + np.linspace(-logSigmaWidth, logSigmaWidth, grid))
+            m, sigma = [x.ravel() for x in np.meshgrid(m, sigma)]
+            a, d, c, error = cls._linearFit(k, w, weights, m, sigma)
+            violation = cls._violation(kGrid, (kGrid[None, :] - m[:, None])/sigma[:, None], a, d, c, sigma, floorW)
+            j = np.lexsort((error, violation))[0]
+            if best is None or (violation[j], error[j]) < best[-2:]:
+                best = (a[j], d[j], c[j], m[j], sigma[j], violation[j], error[j])
+            mCenter, logSigmaCenter = best[3], np.log(best[4])
+            mWidth /= 3; logSigmaWidth /= 3
+
+        # The narrow window of a warm start may hold no arbitrage-free slice, search the whole window again
+        if best[-2] > 0 and previous is not None:
+            return cls.fit(k, w, weights, None, floor, grid, rounds + 2)
+
+        a, d, c, m, sigma, violation, error = best
+        b = c/sigma
+        rho = d/c if c > 0 else 0.0
+        fitted = cls(a, b, rho, m, sigma)
+        fitted.violation = float(violation)
+        return fitted
+
+    @staticmethod
+    def _linearFit(k, w, weights, m, sigma):
+        y = (k[None, :] - m[:, None])/sigma[:, None]
+        X = np.stack([np.ones_like(y), y, np.sqrt(y*y + 1)], axis = 2)
+        Xw = X*weights[None, :, None]
+        A = np.einsum('nki,nkj->nij', Xw, X) + 1e-12*np.eye(3)
+        rhs = np.einsum('nki,k->ni', Xw, w)
+        a, d, c = np.linalg.solve(A, rhs[:, :, None])[:, :, 0].T
+
+        # Project onto the constraints, then refit a (the weighted mean residual)
+        c = np.clip(c, 0, 4*sigma)
+        d = np.clip(d, -np.minimum(c, 4*sigma - c), np.minimum(c, 4*sigma - c))
+        a = ((w[None, :] - d[:, None]*y - c[:, None]*X[:, :, 2])*weights).sum(axis = 1)/weights.sum()
+        rho = np.where(c > 0, d/np.maximum(c, 1e-300), 0)
+        a = np.maximum(a, -c*np.sqrt(1 - rho**2))
+
+        residual = a[:, None] + d[:, None]*y + c[:, None]*X[:, :, 2] - w[None, :]
+        return a, d, c, (weights*residual**2).sum(axis = 1)
+
+    # Largest static arbitrage violation of each candidate on the grid k, y = (k - m)/sigma (candidates, grid)
+    ## g(k) = (1 - k*w'/(2*w))^2 - w'^2/4*(1/w + 1/4) + w''/2 (Gatheral-Jacquier), the density is g(k)/sqrt(w)*n(d2)
+    @staticmethod
+    def _violation(k, y, a, d, c, sigma, floorW = None):
+        root = np.sqrt(y*y + 1)
+        w = a[:, None] + d[:, None]*y + c[:, None]*root
+        dw = (d[:, None] + c[:, None]*y/root)/sigma[:, None]
+        d2w = c[:, None]/(sigma[:, None]*root**3)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            g = (1 - k*dw/(2*w))**2 - dw*dw/4*(1/w + 0.25) + d2w/2
+        g = np.where(w > 0, g, -np.inf)
+        violation = np.maximum(-g.min(axis = 1), 0)
+        if floorW is not None:
+            violation = violation + np.maximum((floorW[None, :] - w).max(axis = 1), 0)
+        return np.where(violation > 1e-10, violation, 0)
+
+# Implied volatility surface from per-expiry SVI slices or one SSVI surface
+## vol(T, K): total variance interpolated linearly in T at fixed log-moneyness k = log(K/F(T)),
+## flat implied volatility beyond the last expiry; log forward interpolated linearly in T
+class VolSurface():
+    def __init__(self, method = 'SVI'):
+        if method not in ('SVI', 'SSVI'):
+            raise ValueError('Surface method must be SVI or SSVI')
+        self.method = method
+        self.expiries = np.array([])
+        self.forwards = np.array([])
+        self.slices = []
+        self.ssvi = None
+        self.quotes = None
+
+    # T, k, iv: arrays of the quotes, T in years, iv in decimals, forwards: {T: forward}
+    ## Slices of the previous snapshot (the same expiry, a few days of decay at most) are used as warm starts
+    def fit(self, T, k, iv, forwards, weights = None):
+        T = np.asarray(T, dtype = float); k = np.asarray(k, dtype = float); iv = np.asarray(iv, dtype = float)
+        weights = np.ones_like(iv) if weights is None else np.asarray(weights, dtype = float)
+        def previous(t):
+            if len(self.expiries) == 0 or self.method != 'SVI':
+                return None
+            i = np.argmin(np.abs(self.expiries - t))
+            return self.slices[i] if abs(self.expiries[i] - t) < 3/365 else None
+
+        expiries = np.unique(T)
+        self.forwards = np.array([forwards[t] for t in expiries])
+        w = iv*iv*T
+        if self.method == 'SVI':
+            # Increasing expiries, each slice is kept above the previous one (no calendar arbitrage)
+            slices = []
+            for t in expiries:
+                index = T == t
+                slices.append(SVISlice.fit(k[index], w[index], weights[index], previous(t), slices[-1] if slices else None))
+            self.slices = slices
+            self.ssvi = None
+
+            # No arbitrage-free SVI slice for some expiry: SSVI surface, free of static arbitrage by construction
+            if any(slice.violation > 0 for slice in slices):
+                self.ssvi = SSVI.fit(T, k, w, weights)
+                self.slices = [self.ssvi.slice(t) for t in expiries]
+        else:
+            self.ssvi = SSVI.fit(T, k, w, weights, self.ssvi)
+            self.slices = [self.ssvi.slice(t) for t in expiries]
+        self.expiries = expiries
+        self.quotes = (T, k, iv)
+        return self
+
+    # Fit from a chain in the btcOptionsData.csv layout, out-of-the-money mark prices only
+    def fitChain(self, df, valuationTime = datetime(2022, 5, 19, 1, 30), minTime = 1/365):
+        ivs, forwards = ImpliedVolatility.chainImpliedVolatility(df, valuationTime, priceColumns = ('mark_price', ))
+        maturity = df['maturity'].to_numpy().astype(str)
+        strike = df['strike'].to_numpy(dtype = float)
+        isCall = df['option_type'].to_numpy() == 'C'
+        forward = np.array([forwards.get(expiry, np.nan) for expiry in maturity])
+        expiryTime = {expiry: datetime.strptime(expiry, '%Y-%m-%d').replace(hour = 8) for expiry in np.unique(maturity)}
+        T = np.array([(expiryTime[expiry] - valuationTime).total_seconds()/(365*24*3600) for expiry in maturity])
+
+        iv = ivs['mark_price']/100
+        otm = np.where(isCall, strike >= forward, strike < forward)
+        use = otm & np.isfinite(iv) & (T >= minTime)
+        forwardOfT = {t: f for t, f in zip(T[use], forward[use])}
+        return self.fit(T[use], np.log(strike[use]/forward[use]), iv[use], forwardOfT)
+
+    # Root mean square error of the fitted quotes, in implied volatility (decimals)
+    def fitError(self):
+        T, k, iv = self.quotes
+        return float(np.sqrt(np.mean((np.sqrt(self.totalVariance(T, k)/T) - iv)**2)))
+
+    def forward(self, T):
+        return np.exp(np.interp(T, self.expiries, np.log(self.forwards)))
+
+    def totalVariance(self, T, k):
+        T, k = np.broadcast_arrays(np.asarray(T, dtype = float), np.asarray(k, dtype = float))
+        if len(self.expiries) == 1:
+            return np.maximum(self.slices[0].totalVariance(k)*T/self.expiries[0], 0)
+
+        # Bracketing slices of each query, only those two slices are evaluated
+        i = np.clip(np.searchsorted(self.expiries, T), 1, len(self.expiries) - 1)
+        T0 = self.expiries[i - 1]; T1 = self.expiries[i]
+        w0 = np.zeros(T.shape); w1 = np.zeros(T.shape)
+        for j in np.unique(i):
+            index = i == j
+            w0[index] = self.slices[j - 1].totalVariance(k[index])
+            w1[index] = self.slices[j].totalVariance(k[index])
+        w = np.where(T <= T0, w0*T/T0,
+            np.where(T >= T1, w1*T/T1, w0 + (T - T0)/(T1 - T0)*(w1 - w0)))
+        return np.maximum(w, 0)
+
+    def vol(self, T, K):
+        T = np.asarray(T, dtype = float)
+        k = np.log(np.asarray(K, dtype = float)/self.forward(T))
+        return np.sqrt(self.totalVariance(T, k)/T)
+
+# SSVI (Gatheral-Jacquier): w(k, theta) = theta/2*(1 + rho*phi*k + sqrt((phi*k + rho)^2 + 1 - rho^2)),
+# phi(theta) = eta/(theta^gamma*(1 + theta)^(1 - gamma)), theta: ATM total variance of each expiry
+## Free of butterfly arbitrage for eta*(1 + |rho|) <= 2 and 0 < gamma <= 1/2,
+## free of calendar arbitrage for a non-decreasing theta
+class SSVI():
+    def __init__(self, expiries, theta, rho, eta, gamma = 0.5):
+        self.expiries = expiries; self.theta = theta
+        self.rho = rho; self.eta = eta; self.gamma = gamma
+
+    def phi(self, theta):
+        return self.eta/(theta**self.gamma*(1 + theta)**(1 - self.gamma))
+
+    def totalVariance(self, theta, k):
+        phi = self.phi(theta)
+        return theta/2*(1 + self.rho*phi*k + np.sqrt((phi*k + self.rho)**2 + 1 - self.rho**2))
+
+    # Raw SVI slice of one expiry
+    def slice(self, T):
+        theta = np.interp(T, self.expiries, self.theta)
+        phi = self.phi(theta)
+        return SVISlice(theta/2*(1 - self.rho**2), theta*phi/2, self.rho, -self.rho/phi, np.sqrt(1 - self.rho**2)/phi)
+
+    @classmethod
+    def fit(cls, T, k, w, weights, previous = None, gamma = 0.5, grid = 21, rounds = 4):
+        # ATM total variance of each expiry from the quotes around k = 0, made non-decreasing
+        expiries = np.unique(T)
+        theta = []
+        for t in expiries:
+            index = T == t
+            order = np.argsort(k[index])
+            theta.append(np.interp(0, k[index][order], w[index][order]))
+        theta = np.maximum.accumulate(np.maximum(theta, 1e-8))
+        thetaOfQuote = np.interp(T, expiries, theta)
+
+        # Grid search over (rho, eta) inside the no-arbitrage region, zoomed around the best candidate
+        if previous is not None:
+            rhoCenter, etaCenter, rhoWidth, etaWidth = previous.rho, previous.eta, 0.1, 0.25*previous.eta
+            rounds = max(rounds - 2, 1)
+        else:
+            rhoCenter, etaCenter, rhoWidth, etaWidth = 0.0, 1.0, 0.99, 1.0
+        best = None
+        for i in range(rounds):
+            rho = np.clip(rhoCenter + np.linspace(-rhoWidth, rhoWidth, grid), -0.999, 0.999)
+            eta = np.clip(etaCenter + np.linspace(-etaWidth, etaWidth, grid), 1e-4, None)
+            rho, eta = [x.ravel() for x in np.meshgrid(rho, eta)]
+            eta = np.minimum(eta, 2/(1 + np.abs(rho)))
+
+            phi = eta[:, None]/(thetaOfQuote**gamma*(1 + thetaOfQuote)**(1 - gamma))[None, :]
+            model = thetaOfQuote/2*(1 + rho[:, None]*phi*k + np.sqrt((phi*k + rho[:, None])**2 + 1 - rho[:, None]**2))
+            error = (weights*(model - w)**2).sum(axis = 1)
+            j = np.argmin(error)
+            if best is None or error[j] < best[-1]:
+                best = (rho[j], eta[j], error[j])
+            rhoCenter, etaCenter = best[0], best[1]
+            rhoWidth /= 4; etaWidth /= 4
+        return cls(expiries, theta, best[0], best[1], gamma)
@@ -1,17 +1,128 @@
 import sys
-import pandas as pd
-import numpy as np
+import time
+startTime = time.perf_counter()
+
+import types
+import multiprocessing
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
-from PyQt5.QtWebEngineWidgets import *
 
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-import matplotlib.pyplot as plt
+import PricingCache
+
+# QuantLib (HestonModel), pandas, matplotlib and QtWebEngine are imported on first use
+
+# Startup timing report
+class StartupTimer():
+    def __init__(self, start):
+        self.start = start
+        self.marks = []
+
+    def mark(self, label):
+        self.marks.append((label, time.perf_counter() - self.start))
+
+    def report(self):
+        last = 0.0
+        lines = ['Startup timing']
+        for label, elapsed in self.marks:
+            lines.append('  %-24s %7.3f s (+%.3f s)' % (label, elapsed, elapsed - last))
+            last = elapsed
+        return '\n'.join(lines)
+
+startupTimer = StartupTimer(startTime)
+startupTimer.mark('imports')
+
+# Heston calibration runs in a separate process, QuantLib holds the GIL while calibrating
+def runCalibration():
+    import HestonModel
+    calibration = HestonModel.Calibration()
+    return types.SimpleNamespace(params = calibration.params, snapshotId = calibration.snapshotId,
+                                 risk_free_rate = calibration.risk_free_rate, dividend_rate = calibration.dividend_rate,
+                                 calibrationQuotes = calibration.calibrationQuotes, calibrationErrors = calibration.calibrationErrors,
+                                 fitError = calibration.fitError)
+
+# Pricing context of a runCalibration result, the model is rebuilt from its params without calibrating again
+def calibratedContext(calibration):
+    import QuantLib as ql
+    import HestonModel
+    calDate = datetime.strptime(calibration.params['CalDate'], '%Y-%m-%d')
+    return HestonModel.Calibration(ql.Date(calDate.day, calDate.month, calDate.year), calibration.params['Spot'], params = calibration.params)
+
+# Digital and down-out barrier pricing surface of the calibrated model, for interactive what-if
+def runPricingSurface(calibration):
+    from datetime import date, timedelta
+    import numpy as np
+    import HestonModel
+    import PricingSurface
+    simulation = HestonModel.ExoticOptionSimulation(calibratedContext(calibration))
+    calculationDate = simulation.calculation_date.to_date()
+    maturities = [str(calculationDate + timedelta(days)) for days in list(range(7, 28, 7)) + list(range(28, 367, 14))]
+    strikes = simulation.spot*np.linspace(0.4, 2.0, 33)
+    barriers = simulation.spot*np.linspace(0.3, 0.95, 14)
+    return PricingSurface.PricingSurface.build(simulation, PricingCache.PricingCache.getModelKey(simulation), maturities, strikes, barriers)
+
+# Stop a worker pool at once: pending work is cancelled and running workers are terminated,
+## shutdown() alone lets a running task finish and the interpreter waits for it at exit
+def terminateExecutor(executor):
+    processes = list((executor._processes or {}).values())
+    executor.shutdown(wait = False, cancel_futures = True)
+    for process in processes:
+        process.terminate()
+
+# Run a function in a worker process, finished (result) or failed (exception) is emitted in the GUI thread
+## start = False: submitted later by submit(*args), e.g. connected to the finished signal of the task it depends on
+## Without an executor the task has its own worker process, shut down once the task is done or by shutdown()
+class BackgroundTask(QObject):
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(object)
+
+    def __init__(self, function, executor = None, parent = None, start = True):
+        super().__init__(parent)
+        self.ownExecutor = executor is None
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context('spawn'))
+        self.function = function
+        self.executor = executor
+        self.result = None
+        self.error = None
+        self.future = None
+        self.finished.connect(self.setResult)
+        self.failed.connect(self.setError)
+        if start:
+            self.submit()
+
+    def submit(self, *args):
+        self.future = self.executor.submit(self.function, *args)
+        self.future.add_done_callback(self.done)
+
+    # Runs in the thread that completed the future, a worker error (e.g. BrokenProcessPool) is forwarded, never raised here
+    def done(self, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            self.failed.emit(error)
+        else:
+            self.finished.emit(future.result())
+
+    def setResult(self, result):
+        self.result = result
+        self.shutdown()
+
+    def setError(self, error):
+        self.error = error
+        self.shutdown()
+
+    def shutdown(self):
+        if self.ownExecutor:
+            terminateExecutor(self.executor)
 
-import HestonModel
+# Progress of a worker thread, connected slots run in the GUI thread
+class ProgressSignal(QObject):
+    progress = pyqtSignal(object)
 
 # System/About windows
 class AboutForm(QMainWindow):
@@ -29,36 +140,28 @@ class AboutForm(QMainWindow):
         self.setCentralWidget(self.centralWidget)
 
 class OptionSimulation(QMainWindow):
-    def __init__(self, parent = None, defaultWindow = ''):
+    def __init__(self, parent = None, defaultWindow = '', pricingCache = None, calibrationTask = None, surfaceTask = None, pathStore = None):
         super(OptionSimulation, self).__init__(parent)
         
         self.defaultWindow = defaultWindow
+        self.pricingCache = pricingCache if pricingCache is not None else PricingCache.PricingCache()
+        self.pathStore = pathStore
         self.setWindowTitle('BitcoinSystem - Option Simulation')
         self.resize(1400, 900)
         self.setMinimumSize(1400, 900)
         self.setMaximumSize(1400, 900)
         
-        # Load Heston model
-        calibration = HestonModel.Calibration()
-        params = calibration.params
-
-        # Heston model parameters table
-        hestonParamsTableHeader = []
-        hestonParamsTable = QTableWidget(1, 7)
-        
-        ## Adding items to the table
-        i = 0
-        for key, value in params.items():
-            hestonParamsTableHeader.append(key)
-            if type(value) != str:
-                value = str(round(value, 2))
-            newItem = QTableWidgetItem(value)
-            newItem.setFont(QFont('Consolas', 24))
-            newItem.setTextAlignment(Qt.AlignHCenter | Qt.AlignVCenter)
-            hestonParamsTable.setItem(0, i, newItem)
-            i += 1
-
-        hestonParamsTable.setHorizontalHeaderLabels(hestonParamsTableHeader)
+        # Heston model parameters table, filled when the calibration is finished
+        self.calibration = None
+        self.pricingContext = None
+        self.hestonParamsTable = QTableWidget(1, 7)
+        hestonParamsTable = self.hestonParamsTable
+        hestonParamsTable.setHorizontalHeaderLabels(['CalDate', 'Spot', 'v0', 'rho', 'kappa', 'theta', 'sigma'])
+        hestonParamsTable.setSpan(0, 0, 1, 7)
+        newItem = QTableWidgetItem('Calibrating Heston model ...')
+        newItem.setFont(QFont('Consolas', 24))
+        newItem.setTextAlignment(Qt.AlignHCenter | Qt.AlignVCenter)
+        hestonParamsTable.setItem(0, 0, newItem)
         hestonParamsTable.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
         hestonParamsTable.horizontalHeader().setFont(QFont('Consolas', 24))
         hestonParamsTable.setRowHeight(0, 1000)
@@ -66,12 +169,25 @@ class OptionSimulation(QMainWindow):
         hestonParamsTable.verticalHeader().setVisible(False)
         hestonParamsTable.setEditTriggers(QAbstractItemView.NoEditTriggers)
         
+        # Load Heston model
+        self.calibrationTask = calibrationTask if calibrationTask is not None else BackgroundTask(runCalibration, parent = self)
+        if self.calibrationTask.result is not None:
+            self.setCalibration(self.calibrationTask.result)
+        elif self.calibrationTask.error is not None:
+            self.setCalibrationError(self.calibrationTask.error)
+        else:
+            self.calibrationTask.finished.connect(self.setCalibration)
+            self.calibrationTask.failed.connect(self.setCalibrationError)
+        
+        # Precomputed pricing surface, optional
+        self.surfaceTask = surfaceTask
+        
         # Option input layout
         ## Option input layout (left)
         ### Option combobox layout
         #### Exotic option select combobox
         self.exoticOptionCombobox = QComboBox(self)
-        self.exoticOptionCombobox.addItems(['Select Exotic Option', 'Vanilla Option', 'Digital Option', 'Barrier Option'])
+        self.exoticOptionCombobox.addItems(['Select Exotic Option', 'Vanilla Option', 'Digital Option', 'Barrier Option', 'Asian Option', 'Lookback Option'])
         self.exoticOptionCombobox.insertSeparator(1)
         self.exoticOptionCombobox.setFont(QFont('Consolas', 24))
         self.exoticOptionCombobox.setFixedSize(700, 50)
@@ -106,24 +222,40 @@ class OptionSimulation(QMainWindow):
         self.digitalInputStack()
         self.barrierInputStackWidget = QWidget()
         self.barrierInputStack()
+        self.asianInputStackWidget = QWidget()
+        self.asianInputStack()
+        self.lookbackInputStackWidget = QWidget()
+        self.lookbackInputStack()
 
         self.optionInputStack = QStackedWidget()
         self.optionInputStack.addWidget(defaultInterfaceLabel)
         self.optionInputStack.addWidget(self.vanillaInputStackWidget)
         self.optionInputStack.addWidget(self.digitalInputStackWidget)
         self.optionInputStack.addWidget(self.barrierInputStackWidget)
+        self.optionInputStack.addWidget(self.asianInputStackWidget)
+        self.optionInputStack.addWidget(self.lookbackInputStackWidget)
         
         #### Enter button
         enterBtn = QPushButton('Enter',self)
-        enterBtn.clicked.connect(self.submit)
+        enterBtn.clicked.connect(lambda: self.submit())
         enterBtn.setFont(QFont('Consolas', 20))
         enterBtn.setFixedSize(200,50)
         
+        #### Exact Monte Carlo button, refines a price read from the pricing surface
+        exactBtn = QPushButton('Exact MC',self)
+        exactBtn.clicked.connect(lambda: self.submit(exact = True))
+        exactBtn.setFont(QFont('Consolas', 20))
+        exactBtn.setFixedSize(200,50)
+        
+        buttonLayout = QHBoxLayout()
+        buttonLayout.addWidget(exactBtn)
+        buttonLayout.addWidget(enterBtn)
+        
         ### Combine condition layout
         conditionLayout = QVBoxLayout()
         conditionLayout.addLayout(optionComboboxLayout)
         conditionLayout.addWidget(self.optionInputStack)
-        conditionLayout.addWidget(enterBtn, 0, Qt.AlignRight | Qt.AlignBottom)
+        conditionLayout.addLayout(buttonLayout)
         
         ## Option input layout (right)
         ### Expiration text
@@ -178,7 +310,47 @@ class OptionSimulation(QMainWindow):
         elif self.defaultWindow == 'Barrier Option':
             self.exoticOptionCombobox.setCurrentText('Barrier Option')
             self.optionInputStack.setCurrentIndex(3)
+        elif self.defaultWindow == 'Asian Option':
+            self.exoticOptionCombobox.setCurrentText('Asian Option')
+            self.optionInputStack.setCurrentIndex(4)
+        elif self.defaultWindow == 'Lookback Option':
+            self.exoticOptionCombobox.setCurrentText('Lookback Option')
+            self.optionInputStack.setCurrentIndex(5)
+        
+    def setCalibration(self, calibration):
+        self.calibration = calibration
+        self.pricingContext = None
+        self.pricingCache.bind(PricingCache.PricingCache.getModelKey(calibration))
+        if self.pathStore is not None:
+            self.pathStore.bind(self.pricingCache.modelKey)
+
+        ## Adding items to the table
+        self.hestonParamsTable.setSpan(0, 0, 1, 1)
+        i = 0
+        for key, value in calibration.params.items():
+            if type(value) != str:
+                value = str(round(value, 2))
+            newItem = QTableWidgetItem(value)
+            newItem.setFont(QFont('Consolas', 24))
+            newItem.setTextAlignment(Qt.AlignHCenter | Qt.AlignVCenter)
+            self.hestonParamsTable.setItem(0, i, newItem)
+            i += 1
         
+    def setCalibrationError(self, error):
+        self.hestonParamsTable.item(0, 0).setText('Calibration failed: %s' % (error, ))
+    
+    # A calibration task of this window only is stopped with it
+    def closeEvent(self, event):
+        if self.calibrationTask.parent() is self:
+            self.calibrationTask.shutdown()
+        super().closeEvent(event)
+    
+    # Pricers share the model of the background calibration, built on first use
+    def getPricingContext(self):
+        if self.pricingContext is None:
+            self.pricingContext = calibratedContext(self.calibration)
+        return self.pricingContext
+    
     def exoticOptionComboboxClicked(self):
         self.exoticOptionCombobox.model().item(0).setEnabled(False)
         if self.exoticOptionCombobox.currentText() == "Vanilla Option":
@@ -187,6 +359,10 @@ class OptionSimulation(QMainWindow):
             self.optionInputStack.setCurrentIndex(2)
         elif self.exoticOptionCombobox.currentText() == "Barrier Option":
             self.optionInputStack.setCurrentIndex(3)
+        elif self.exoticOptionCombobox.currentText() == "Asian Option":
+            self.optionInputStack.setCurrentIndex(4)
+        elif self.exoticOptionCombobox.currentText() == "Lookback Option":
+            self.optionInputStack.setCurrentIndex(5)
             
     def optionTypeComboboxClicked(self):
         self.optionTypeCombobox.model().item(0).setEnabled(False)
@@ -198,10 +374,18 @@ class OptionSimulation(QMainWindow):
     def showDate(self,date):
         self.date = date.toString('yyyy-MM-dd')
         
-    def submit(self):
+    def submit(self, exact = False):
         # Warning and default value
         maturity = self.date
         
+        ## Check the calibration
+        if self.calibration is None:
+            if self.calibrationTask.error is not None:
+                QMessageBox.warning(self, 'Warning', 'Heston model calibration failed: %s' % (self.calibrationTask.error, ))
+            else:
+                QMessageBox.warning(self, 'Warning', 'Heston model calibration is still running!')
+            return
+        
         ## Check the exotic option
         if self.exoticOptionCombobox.currentText() == 'Select Exotic Option':
             if self.defaultWindow == '':
@@ -223,46 +407,123 @@ class OptionSimulation(QMainWindow):
                 QMessageBox.warning(self, 'Warning', 'Did not select barrier Type!')
                 return
         
-        ## Check the strike
-        if not (self.vanillaStrike.text() or self.digitalStrike.text() or self.barrierStrike.text() != ''):
+        ## Check the strike, floating strike lookback has none
+        strikeInput = {'Vanilla Option': self.vanillaStrike, 'Digital Option': self.digitalStrike, 'Barrier Option': self.barrierStrike,
+                       'Asian Option': self.asianStrike, 'Lookback Option': self.lookbackStrike}[exoticOptionType]
+        floatingStrike = exoticOptionType == "Lookback Option" and self.lookbackCombobox.currentText() == 'Floating'
+        if strikeInput.text() == '' and not floatingStrike:
             QMessageBox.warning(self, 'Warning', 'Did not input strike!')
             return
         
+        # Read the NPV from the pricing surface, when available for this model and inside the grid
+        surface = self.surfaceTask.result if self.surfaceTask is not None else None
+        if not exact and surface is not None and surface.modelKey == self.pricingCache.modelKey:
+            step = (datetime.strptime(maturity, '%Y-%m-%d') - datetime.strptime(self.calibration.params['CalDate'], '%Y-%m-%d')).days
+            result = None
+            if exoticOptionType == "Digital Option":
+                result = surface.digitalNPV(self.optionType, step, float(self.digitalStrike.text()))
+            elif exoticOptionType == "Barrier Option" and self.barrierType == 'DownOut' and not self.barrierDigitalCheckbox.isChecked() and self.downBarrier.text() != '':
+                result = surface.downoutNPV(self.optionType, step, float(self.barrierStrike.text()), float(self.downBarrier.text()))
+            if result is not None:
+                NPV, errorBound = result
+                self.npvWidget.setText('Net Present Value = %.6g \u00b1 %.2g (pricing surface)' % (NPV, errorBound))
+                self.statusBar().showMessage('Interpolated from the pricing surface, press Exact MC to refine')
+                return
+        
         # Calculate the NPV
+        import HestonModel
+        import Payoff
         if exoticOptionType == "Vanilla Option":
-            vanilla = HestonModel.VanillaOptionSimulation()
             strike = float(self.vanillaStrike.text())
-            if self.optionType == 'Call':
-                NPV = vanilla.callNPV(maturity, strike)
-            elif self.optionType == 'Put':
-                NPV = vanilla.putNPV(maturity, strike)
+            contractKey = PricingCache.PricingCache.getContractKey(exoticOptionType, maturity, strike, self.optionType)
+            def pricer():
+                vanilla = HestonModel.VanillaOptionSimulation(self.getPricingContext())
+                if self.optionType == 'Call':
+                    return vanilla.callNPV(maturity, strike)
+                elif self.optionType == 'Put':
+                    return vanilla.putNPV(maturity, strike)
                 
         elif exoticOptionType == "Digital Option":
-            digital = HestonModel.DigitalOptionSimulation()
             strike = float(self.digitalStrike.text())
-            if self.optionType == 'Call':
-                NPV = digital.callNPV(maturity, strike)
-            elif self.optionType == 'Put':
-                NPV = digital.putNPV(maturity, strike)
+            ## Conditional Monte Carlo on the variance paths, discounted
+            contractKey = PricingCache.PricingCache.getContractKey(exoticOptionType, maturity, strike, self.optionType, 'Conditional',
+                                                                   path = 2000, scheme = HestonModel.MonteCarloSimulation.scheme)
+            def pricer():
+                digital = HestonModel.DigitalOptionSimulation(self.getPricingContext())
+                if self.optionType == 'Call':
+                    return digital.callNPVConditional(maturity, strike).NPV
+                elif self.optionType == 'Put':
+                    return digital.putNPVConditional(maturity, strike).NPV
 
         elif exoticOptionType == "Barrier Option":
-            barrier = HestonModel.BarrierOptionSimulation()
             strike = float(self.barrierStrike.text())
             
-            if self.barrierType == 'DownOut':
+            downBarrier = None
+            if self.barrierType in ('DownOut', 'DoubleOut'):
                 ## Check the down barrier
                 if self.downBarrier.text() == '':
                     QMessageBox.warning(self, 'Warning', 'Did not input down barrier!')
                     return
                 else:
                     downBarrier = float(self.downBarrier.text())
-
-                if self.optionType == 'Call':
-                    NPV = barrier.downoutCallNPV(maturity, strike, downBarrier)
-                elif self.optionType == 'Put':
-                    NPV = barrier.downoutPutNPV(maturity, strike, downBarrier)
-        
+            
+            upBarrier = None
+            if self.barrierType in ('UpOut', 'DoubleOut'):
+                ## Check the up barrier
+                if self.upBarrier.text() == '':
+                    QMessageBox.warning(self, 'Warning', 'Did not input up barrier!')
+                    return
+                else:
+                    upBarrier = float(self.upBarrier.text())
+            
+            if self.barrierDigitalCheckbox.isChecked():
+                payoff = Payoff.DigitalBarrierPayoff(self.optionType, strike, downBarrier, upBarrier)
+            else:
+                payoff = Payoff.BarrierPayoff(self.optionType, strike, downBarrier, upBarrier)
+            
+            contractKey = PricingCache.PricingCache.getContractKey(exoticOptionType, maturity, strike, self.optionType, repr(payoff),
+                                                                   path = 20000, scheme = HestonModel.MonteCarloSimulation.scheme)
+            if self.barrierType == 'DownOut' and not self.barrierDigitalCheckbox.isChecked():
+                def pricer():
+                    barrier = HestonModel.BarrierOptionSimulation(self.getPricingContext())
+                    if self.optionType == 'Call':
+                        return barrier.downoutCallNPV(maturity, strike, downBarrier, pathStore = self.pathStore)
+                    elif self.optionType == 'Put':
+                        return barrier.downoutPutNPV(maturity, strike, downBarrier, pathStore = self.pathStore)
+            else:
+                def pricer():
+                    exotic = HestonModel.ExoticOptionSimulation(self.getPricingContext())
+                    return exotic.NPV(maturity, [payoff], pathStore = self.pathStore)[0]
+        
+        elif exoticOptionType == "Asian Option":
+            strike = float(self.asianStrike.text())
+            payoff = Payoff.AsianPayoff(self.optionType, strike, self.asianCombobox.currentText())
+            contractKey = PricingCache.PricingCache.getContractKey(exoticOptionType, maturity, strike, self.optionType, repr(payoff),
+                                                                   path = 20000, scheme = HestonModel.MonteCarloSimulation.scheme)
+            def pricer():
+                exotic = HestonModel.ExoticOptionSimulation(self.getPricingContext())
+                return exotic.NPV(maturity, [payoff], pathStore = self.pathStore)[0]
+        
+        elif exoticOptionType == "Lookback Option":
+            strike = None if floatingStrike else float(self.lookbackStrike.text())
+            payoff = Payoff.LookbackPayoff(self.optionType, strike)
+            contractKey = PricingCache.PricingCache.getContractKey(exoticOptionType, maturity, 0 if strike is None else strike, self.optionType, repr(payoff),
+                                                                   path = 20000, scheme = HestonModel.MonteCarloSimulation.scheme)
+            def pricer():
+                exotic = HestonModel.ExoticOptionSimulation(self.getPricingContext())
+                return exotic.NPV(maturity, [payoff], pathStore = self.pathStore)[0]
+        
+        try:
+            NPV = self.pricingCache.price(contractKey, pricer)
+        except ValueError as error:
+            QMessageBox.warning(self, 'Warning', str(error))
+            return
         self.npvWidget.setText('Net Present Value = ' + str(round(NPV, 2)))
+        
+        # Cache metrics
+        metrics = self.pricingCache.metrics()
+        self.statusBar().showMessage('Pricing cache: hit rate %.0f%% (%d hits, %d misses), saved %.1f s' %
+                                     (metrics['hitRate']*100, metrics['hits'] + metrics['diskHits'], metrics['misses'], metrics['savedTime']))
     
     def vanillaInputStack(self):
         layout = QVBoxLayout()
@@ -307,7 +568,7 @@ class OptionSimulation(QMainWindow):
         layout = QVBoxLayout()
         
         self.barrierCombobox = QComboBox(self)
-        self.barrierCombobox.addItems(['Barrier Type', 'DownOut'])
+        self.barrierCombobox.addItems(['Barrier Type', 'DownOut', 'UpOut', 'DoubleOut'])
         self.barrierCombobox.currentIndexChanged.connect(self.barrierComboboxClick)
         self.barrierCombobox.insertSeparator(1)
         self.barrierCombobox.setFixedHeight(50)
@@ -345,12 +606,16 @@ class OptionSimulation(QMainWindow):
         self.downBarrierWord.setFont(QFont('Consolas', 20))
         self.downBarrierWord.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
         self.downBarrierLayout.addRow(self.downBarrierWord, self.downBarrier)
+        
+        self.barrierDigitalCheckbox = QCheckBox('Digital payoff')
+        self.barrierDigitalCheckbox.setFont(QFont('Consolas', 20))
 
         # Total
         layout.addWidget(self.barrierCombobox)
         layout.addLayout(strikeLayout)
         layout.addLayout(self.upBarrierLayout)
         layout.addLayout(self.downBarrierLayout)
+        layout.addWidget(self.barrierDigitalCheckbox)
 
         self.barrierInputStackWidget.setLayout(layout)
 
@@ -360,6 +625,70 @@ class OptionSimulation(QMainWindow):
             self.upBarrier.setEnabled(False)
             self.downBarrier.setEnabled(True)
             self.barrierType = self.barrierCombobox.currentText()
+        elif self.barrierCombobox.currentText() == 'UpOut':
+            self.upBarrier.setEnabled(True)
+            self.downBarrier.setEnabled(False)
+            self.barrierType = self.barrierCombobox.currentText()
+        elif self.barrierCombobox.currentText() == 'DoubleOut':
+            self.upBarrier.setEnabled(True)
+            self.downBarrier.setEnabled(True)
+            self.barrierType = self.barrierCombobox.currentText()
+    
+    def asianInputStack(self):
+        layout = QVBoxLayout()
+        
+        self.asianCombobox = QComboBox(self)
+        self.asianCombobox.addItems(['Arithmetic', 'Geometric'])
+        self.asianCombobox.setFixedHeight(50)
+        self.asianCombobox.setFont(QFont('Consolas', 20))
+        
+        # Strike
+        strikeLayout = QFormLayout()
+        self.asianStrike = QLineEdit()
+        self.asianStrike.setFixedHeight(50)
+        self.asianStrike.setFont(QFont('Consolas', 20))
+        self.asianStrike.setAlignment(Qt.AlignHCenter | Qt.AlignVCenter)
+        strikeWord = QLabel('Strike: ')
+        strikeWord.setFixedSize(210, 50)
+        strikeWord.setFont(QFont('Consolas', 20))
+        strikeWord.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
+        strikeLayout.addRow(strikeWord, self.asianStrike)
+
+        # Total
+        layout.addWidget(self.asianCombobox)
+        layout.addLayout(strikeLayout)
+
+        self.asianInputStackWidget.setLayout(layout)
+    
+    def lookbackInputStack(self):
+        layout = QVBoxLayout()
+        
+        self.lookbackCombobox = QComboBox(self)
+        self.lookbackCombobox.addItems(['Fixed', 'Floating'])
+        self.lookbackCombobox.currentIndexChanged.connect(self.lookbackComboboxClick)
+        self.lookbackCombobox.setFixedHeight(50)
+        self.lookbackCombobox.setFont(QFont('Consolas', 20))
+        
+        # Strike
+        strikeLayout = QFormLayout()
+        self.lookbackStrike = QLineEdit()
+        self.lookbackStrike.setFixedHeight(50)
+        self.lookbackStrike.setFont(QFont('Consolas', 20))
+        self.lookbackStrike.setAlignment(Qt.AlignHCenter | Qt.AlignVCenter)
+        strikeWord = QLabel('Strike: ')
+        strikeWord.setFixedSize(210, 50)
+        strikeWord.setFont(QFont('Consolas', 20))
+        strikeWord.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
+        strikeLayout.addRow(strikeWord, self.lookbackStrike)
+
+        # Total
+        layout.addWidget(self.lookbackCombobox)
+        layout.addLayout(strikeLayout)
+
+        self.lookbackInputStackWidget.setLayout(layout)
+    
+    def lookbackComboboxClick(self):
+        self.lookbackStrike.setEnabled(self.lookbackCombobox.currentText() == 'Fixed')
 
 class MainWindow(QMainWindow):
     def __init__(self, parent = None):
@@ -371,12 +700,14 @@ class MainWindow(QMainWindow):
         self.resize(Width, Height)
         self.setFixedSize(Width, Height)
         
-        # Background figure
-        palette = QPalette()
-        fig = QPixmap('mainWindowBackground.jpg')
-        fig = fig.scaled(self.width(), self.height())
-        palette.setBrush(QPalette.Background, QBrush(fig))
-        self.setPalette(palette)
+        # Pricing result cache shared by option simulation windows
+        self.pricingCache = PricingCache.PricingCache(diskPath = 'pricingCache.sqlite')
+        self.pathStore = None
+        
+        # Heston calibration and pricing surface, started in the background once the window is shown
+        self.executor = ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context('spawn'))
+        self.calibrationTask = None
+        self.surfaceTask = None
 
         # Start interface
         ## Wellcome message
@@ -426,27 +757,74 @@ class MainWindow(QMainWindow):
         startInterfaceLayout.addLayout(buttonLayout)
         startInterfaceLayout.addWidget(copyright)
         
-        # Stack Layout
+        # Stack Layout, each stack is built the first time it is shown
         startInterfaceStackWidget = QWidget()
         startInterfaceStackWidget.setLayout(startInterfaceLayout)
         self.spotStackWidget = QWidget()
-        self.spotStack()
         self.optionStackWidget = QWidget()
-        self.optionStack()
         self.rateStackWidget = QWidget()
-        self.rateStack()
+        self.chartStackWidget = QWidget()
+        self.stackBuilders = {1: self.spotStack, 2: self.optionStack, 3: self.rateStack, 4: self.chartStack}
+        self.rateData = None
+        self.convergenceThread = None
 
         self.mainWindowStack = QStackedWidget()
         self.mainWindowStack.addWidget(startInterfaceStackWidget)
         self.mainWindowStack.addWidget(self.spotStackWidget)
         self.mainWindowStack.addWidget(self.optionStackWidget)
         self.mainWindowStack.addWidget(self.rateStackWidget)
+        self.mainWindowStack.addWidget(self.chartStackWidget)
         
         # Main Window
         self.setCentralWidget(self.mainWindowStack)
         self._createActions()
         self._createMenuBar()
         self._connectActions()
+        startupTimer.mark('main window')
+    
+    def showEvent(self, event):
+        super().showEvent(event)
+        if self.calibrationTask is None:
+            QTimer.singleShot(0, self.firstShown)
+    
+    def firstShown(self):
+        if self.calibrationTask is not None:
+            return
+        startupTimer.mark('first window')
+        print(startupTimer.report())
+        self.calibrationTask = BackgroundTask(runCalibration, self.executor, self)
+        self.surfaceTask = BackgroundTask(runPricingSurface, self.executor, self, start = False)
+        self.calibrationTask.finished.connect(self.surfaceTask.submit)
+        QTimer.singleShot(0, self.loadBackground)
+    
+    # Background figure
+    def loadBackground(self):
+        palette = QPalette()
+        fig = QPixmap('mainWindowBackground.jpg')
+        fig = fig.scaled(self.width(), self.height())
+        palette.setBrush(QPalette.Background, QBrush(fig))
+        self.setPalette(palette)
+    
+    def closeEvent(self, event):
+        terminateExecutor(self.executor)
+        self.pricingCache.close()
+        if self.pathStore is not None:
+            self.pathStore.close()
+        super().closeEvent(event)
+    
+    # Simulated paths shared by option simulation windows, created on first use
+    def getPathStore(self):
+        if self.pathStore is None:
+            import PathStore
+            self.pathStore = PathStore.PathStore()
+        return self.pathStore
+    
+    def showStack(self, index):
+        if index in self.stackBuilders:
+            start = time.perf_counter()
+            self.stackBuilders.pop(index)()
+            self.statusBar().showMessage('Loaded in %.2f s' % (time.perf_counter() - start), 3000)
+        self.mainWindowStack.setCurrentIndex(index)
     
     def _createMenuBar(self):
         menuBar = self.menuBar()
@@ -468,6 +846,12 @@ class MainWindow(QMainWindow):
         simulationMenu.addAction(self.vanillaAction)
         simulationMenu.addAction(self.digitalAction)
         simulationMenu.addAction(self.barrierAction)
+        simulationMenu.addAction(self.asianAction)
+        simulationMenu.addAction(self.lookbackAction)
+
+        # Analytics
+        analyticsMenu = menuBar.addMenu("Analytics")
+        analyticsMenu.addAction(self.chartAction)
     
     def _createActions(self):
         # System actions
@@ -491,6 +875,14 @@ class MainWindow(QMainWindow):
         self.digitalAction.setText("Digital")
         self.barrierAction = QAction(self)
         self.barrierAction.setText("Barrier")
+        self.asianAction = QAction(self)
+        self.asianAction.setText("Asian")
+        self.lookbackAction = QAction(self)
+        self.lookbackAction.setText("Lookback")
+        
+        # Analytics actions
+        self.chartAction = QAction(self)
+        self.chartAction.setText("Live Charts")
     
     def _connectActions(self):
         # Connect System actions
@@ -506,6 +898,11 @@ class MainWindow(QMainWindow):
         self.vanillaAction.triggered.connect(self.slot_vanillaAction)
         self.digitalAction.triggered.connect(self.slot_digitalAction)
         self.barrierAction.triggered.connect(self.slot_barrierAction)
+        self.asianAction.triggered.connect(self.slot_asianAction)
+        self.lookbackAction.triggered.connect(self.slot_lookbackAction)
+        
+        # Connect Analytics actions
+        self.chartAction.triggered.connect(self.slot_chartAction)
 
     # Slots
     ## System actions
@@ -519,32 +916,45 @@ class MainWindow(QMainWindow):
     
     ## MarketData actions
     def slot_spotAction(self):
-        self.mainWindowStack.setCurrentIndex(1)
+        self.showStack(1)
     
     def slot_optionAction(self):
-        self.mainWindowStack.setCurrentIndex(2)
+        self.showStack(2)
 
     def slot_rateAction(self):
-        self.mainWindowStack.setCurrentIndex(3)
+        self.showStack(3)
     
     ## OptionSimulation actions
     def slot_vanillaAction(self):
-        optionSimulation = OptionSimulation(self, defaultWindow = 'Vanilla Option')
+        optionSimulation = OptionSimulation(self, defaultWindow = 'Vanilla Option', pricingCache = self.pricingCache, calibrationTask = self.calibrationTask, surfaceTask = self.surfaceTask, pathStore = self.getPathStore())
         optionSimulation.show()
     
     def slot_digitalAction(self):
-        optionSimulation = OptionSimulation(self, defaultWindow = 'Digital Option')
+        optionSimulation = OptionSimulation(self, defaultWindow = 'Digital Option', pricingCache = self.pricingCache, calibrationTask = self.calibrationTask, surfaceTask = self.surfaceTask, pathStore = self.getPathStore())
         optionSimulation.show()
 
     def slot_barrierAction(self):
-        optionSimulation = OptionSimulation(self, defaultWindow = 'Barrier Option')
+        optionSimulation = OptionSimulation(self, defaultWindow = 'Barrier Option', pricingCache = self.pricingCache, calibrationTask = self.calibrationTask, surfaceTask = self.surfaceTask, pathStore = self.getPathStore())
+        optionSimulation.show()
+
+    def slot_asianAction(self):
+        optionSimulation = OptionSimulation(self, defaultWindow = 'Asian Option', pricingCache = self.pricingCache, calibrationTask = self.calibrationTask, surfaceTask = self.surfaceTask, pathStore = self.getPathStore())
+        optionSimulation.show()
+
+    def slot_lookbackAction(self):
+        optionSimulation = OptionSimulation(self, defaultWindow = 'Lookback Option', pricingCache = self.pricingCache, calibrationTask = self.calibrationTask, surfaceTask = self.surfaceTask, pathStore = self.getPathStore())
         optionSimulation.show()
     
+    ## Analytics actions
+    def slot_chartAction(self):
+        self.showStack(4)
+    
     def slot_optionSimulationMainWindowAction(self):
-        optionSimulation = OptionSimulation(self)
+        optionSimulation = OptionSimulation(self, pricingCache = self.pricingCache, calibrationTask = self.calibrationTask, surfaceTask = self.surfaceTask, pathStore = self.getPathStore())
         optionSimulation.show()
     
     def spotStack(self):
+        from PyQt5.QtWebEngineWidgets import QWebEngineView
         layout = QVBoxLayout()
         
         web = QWebEngineView()
@@ -557,6 +967,8 @@ class MainWindow(QMainWindow):
     ## Option stack window set
     def optionStack(self):
         # Load bitcoin data
+        import numpy as np
+        import pandas as pd
         self.df = pd.read_csv('btcOptionsData.csv')
         # Get maturity
         maturity = np.unique(self.df['maturity']).tolist()
@@ -713,16 +1125,15 @@ class MainWindow(QMainWindow):
         zeroRateDataTableWidget.setEditTriggers(QAbstractItemView.NoEditTriggers)
         zeroRateDataTableWidget.verticalHeader().setDefaultSectionSize(50)
         
-        self.figure = plt.figure(figsize = (7, 7))
-        self.canvas = FigureCanvas(self.figure)
+        import LiveChart
+        self.curveChart = LiveChart.LiveChart(figsize = (7, 7))
+        self.curveAx = self.curveChart.figure.add_subplot()
+        self.curveLine = self.curveChart.addArtist(self.curveAx.plot([], [], '-o', color = 'b')[0])
         
         layout = QVBoxLayout()
         layout.addLayout(imformationLayout)
         layout.addWidget(zeroRateDataTableWidget)
-        layout.addWidget(self.canvas)
-        
-        # Get Rate data
-        self.rateData = HestonModel.RateData()
+        layout.addWidget(self.curveChart)
         
         # reference: https://www.geeksforgeeks.org/how-to-embed-matplotlib-graph-in-pyqt5/
         self.rateStackWidget.setLayout(layout)
@@ -730,23 +1141,142 @@ class MainWindow(QMainWindow):
     def curveTypeComboboxCliked(self):
         self.curveTypeCombobox.model().item(0).setEnabled(False)
         curveType = self.curveTypeCombobox.currentText()
-        self.figure.clear()
+        
+        # Get Rate data, monthly tick labels from the curve's own dates
+        if self.rateData is None:
+            import HestonModel
+            self.rateData = HestonModel.RateData()
+            dates = self.rateData.getCurveDates()
+            self.curveAx.set_xticks(range(len(dates)))
+            self.curveAx.set_xticklabels(dates, rotation = 45)
+            self.curveChart.rescale = True
+        
         if curveType == 'Zero Curve':
             data = self.rateData.getZeroCurve()
         elif curveType == 'Discount Curve':
             data = self.rateData.getDiscountCurve()
         
-        ax = self.figure.add_subplot()
-        ax.plot(data, '-o', color = 'b')
-        ax.xaxis.set_ticks([0,1,2,3,4,5,6,7,8,9,10,11,12]) 
-        xlabels = ['2021-11-23', '2021-12-23', '2022-01-23', '2022-02-23', '2022-03-23', '2022-04-23', '2022-05-23', '2022-06-23', '2022-07-23', '2022-08-23', '2022-09-23', '2022-10-23', '2022-11-23']
-        ax.set_xticklabels(xlabels, rotation = 45)
-        # self.figure.set_size_inches(15, 15)
-        self.figure.tight_layout()
-        self.canvas.draw()
+        # Only the line is redrawn, the axes when the range changes
+        self.curveLine.set_data(range(len(data)), data)
+        self.curveChart.fit(self.curveAx, range(len(data)), data, exact = True)
+        self.curveChart.changed()
+    
+    # Live charts: market vs model smile, Monte Carlo convergence and calibration error
+    def chartStack(self):
+        import pandas as pd
+        import VolSurface
+        import LiveChart
+        
+        # Option chain and its SVI surface
+        self.chainData = pd.read_csv('btcOptionsData.csv')
+        self.chainTime = datetime(2022, 5, 19, 1, 30)
+        self.chainSurface = VolSurface.VolSurface('SVI').fitChain(self.chainData, self.chainTime)
+        
+        # Maturity combobox, maturities on the surface
+        self.smileMaturityCombobox = QComboBox(self)
+        for maturity in sorted(set(self.chainData['maturity'].astype(str))):
+            if self.yearFraction(maturity) >= self.chainSurface.expiries[0]:
+                self.smileMaturityCombobox.addItem(maturity)
+        self.smileMaturityCombobox.setFont(QFont('Consolas', 20))
+        self.smileMaturityCombobox.setFixedWidth(300)
+        self.smileMaturityCombobox.currentIndexChanged.connect(self.smileMaturityComboboxClicked)
+        
+        # Monte Carlo convergence run
+        runButton = QPushButton('Run Monte Carlo', self)
+        runButton.setFont(QFont('Consolas', 20))
+        runButton.setFixedWidth(300)
+        runButton.clicked.connect(self.runConvergence)
+        
+        controlLayout = QHBoxLayout()
+        controlLayout.addWidget(self.smileMaturityCombobox)
+        controlLayout.addWidget(runButton)
+        controlLayout.addStretch()
+        
+        self.smileChart = LiveChart.SmileChart()
+        self.convergenceChart = LiveChart.ConvergenceChart()
+        self.calibrationErrorChart = LiveChart.CalibrationErrorChart()
+        self.convergenceSignal = ProgressSignal(self)
+        self.convergenceSignal.progress.connect(self.convergenceChart.addPoint)
+        
+        chartLayout = QGridLayout()
+        chartLayout.addWidget(self.smileChart, 0, 0, 1, 2)
+        chartLayout.addWidget(self.convergenceChart, 1, 0)
+        chartLayout.addWidget(self.calibrationErrorChart, 1, 1)
+        
+        layout = QVBoxLayout()
+        layout.addLayout(controlLayout)
+        layout.addLayout(chartLayout)
+        self.chartStackWidget.setLayout(layout)
+        
+        self.smileMaturityComboboxClicked()
+        if self.calibrationTask is not None:
+            if self.calibrationTask.result is not None:
+                self.setCalibrationErrors(self.calibrationTask.result)
+            elif self.calibrationTask.error is not None:
+                self.setCalibrationFailed(self.calibrationTask.error)
+            else:
+                self.calibrationTask.finished.connect(self.setCalibrationErrors)
+                self.calibrationTask.failed.connect(self.setCalibrationFailed)
+    
+    # Year fraction from the chain snapshot to an expiry at 08:00 UTC
+    def yearFraction(self, maturity):
+        return (datetime.strptime(maturity, '%Y-%m-%d').replace(hour = 8) - self.chainTime).total_seconds()/(365*24*3600)
+    
+    def smileMaturityComboboxClicked(self):
+        import numpy as np
+        maturity = self.smileMaturityCombobox.currentText()
+        T = self.yearFraction(maturity)
+        chain = self.chainData[(self.chainData['maturity'].astype(str) == maturity) & (self.chainData['mark_iv'] > 0)]
+        strikes = chain['strike'].to_numpy(dtype = float)
+        
+        ## Model over the log-moneyness range the slice was fitted to, no wing extrapolation
+        fittedT, fittedK, fittedVol = self.chainSurface.quotes
+        fittedK = fittedK[np.isclose(fittedT, T)]
+        modelStrikes = self.chainSurface.forward(T)*np.exp(np.linspace(fittedK.min(), fittedK.max(), 100))
+        modelVol = self.chainSurface.vol(T, modelStrikes)*100
+        self.smileChart.setSmile('Smile %s' % (maturity, ), strikes, chain['mark_iv'].to_numpy(dtype = float), modelStrikes, modelVol)
+    
+    def setCalibrationErrors(self, calibration):
+        strikes = [strike for days, strike, vol in calibration.calibrationQuotes]
+        errors = [error*100 for error in calibration.calibrationErrors]
+        self.calibrationErrorChart.setErrors('Heston calibration, RMS error %.2f%%' % (calibration.fitError*100, ), strikes, errors)
+    
+    def setCalibrationFailed(self, error):
+        self.calibrationErrorChart.setErrors('Heston calibration failed: %s' % (error, ), [], [])
+    
+    # At-the-money digital call on the calibrated model, batches streamed to the convergence chart from a worker thread
+    def runConvergence(self):
+        calibration = self.calibrationTask.result if self.calibrationTask is not None else None
+        if calibration is None:
+            if self.calibrationTask is not None and self.calibrationTask.error is not None:
+                QMessageBox.warning(self, 'Warning', 'Heston model calibration failed: %s' % (self.calibrationTask.error, ))
+            else:
+                QMessageBox.warning(self, 'Warning', 'Heston model is still calibrating!')
+            return
+        if self.convergenceThread is not None and self.convergenceThread.is_alive():
+            return
+        
+        import threading
+        import HestonModel
+        import Payoff
+        params = calibration.params
+        simulation = HestonModel.MonteCarloSimulation()
+        payoff = Payoff.DigitalPayoff('Call', params['Spot'])
+        
+        ## Discounted as the digital pricers
+        context = calibratedContext(calibration)
+        maturity, step, discount_rate = context.maturitySchedule(str((context.calculation_date + 90).to_date()))
+        sampler = lambda path, seed: simulation.hestonPayoffs(params['Spot'], calibration.dividend_rate, params['v0'], params['kappa'], params['theta'],
+                                                              params['sigma'], params['rho'], step, path, [payoff], seed)[0]*discount_rate
+        self.convergenceChart.reset('At-the-money digital call, %d days' % (step, ))
+        self.convergenceThread = threading.Thread(target = simulation.adaptiveSimulation, args = (sampler, ),
+                                                  kwargs = {'relError': 0.001, 'callback': self.convergenceSignal.progress.emit}, daemon = True)
+        self.convergenceThread.start()
 
 if __name__ == "__main__":
     # Create the application
+    ## QtWebEngine is imported after the application is created, which needs shared OpenGL contexts
+    QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
     app = QApplication(sys.argv)
 
     # Create and show the main window